@@ -25,8 +25,11 @@ from django.forms import BaseForm
 from django import forms
 
 from django.conf import settings
+from django.db import transaction
 
-from models import Field, FieldValue
+from models import Field, FieldValue, field_schema, save_field_values
+from fulltext import get_backend
+from versions import get_version, prune
 
 __all__ = ('AdForm',)
 
@@ -106,6 +109,20 @@ class TinyMCEWidget(forms.Textarea):
 
 from django.forms.fields import EMPTY_VALUES
 import re
+
+# settings.FORBIDDEN_WORDS as a single pattern, longest words first
+FORBIDDEN_WORDS = [word for word in settings.FORBIDDEN_WORDS.split(',') if word]
+FORBIDDEN_WORDS.sort(key=len, reverse=True)
+if FORBIDDEN_WORDS:
+	FORBIDDEN_WORDS_RE = re.compile('|'.join([re.escape(word) for word in FORBIDDEN_WORDS]))
+else:
+	FORBIDDEN_WORDS_RE = None
+
+def strip_forbidden_words(value):
+	if FORBIDDEN_WORDS_RE is None:
+		return value
+	return FORBIDDEN_WORDS_RE.sub('', value)
+
 class TinyMCEField(forms.CharField):
 	def clean(self, value):
 		"Validates max_length and min_length. Returns a Unicode object."
@@ -130,12 +147,24 @@ class TinyMCEField(forms.CharField):
 		return value
 		
 
+# (category id, schema version) => form fields, see fields_for_ad
+_compiled_fields = {}
+
 def fields_for_ad(instance):
-	# generate a sorted dict of fields corresponding to the Field model
-	# for the Ad instance
+	# the form fields are only built once per category and schema version
+	# (see models.field_schema).  BaseForm works on a deep copy of
+	# base_fields, so the cached fields are never modified.
+	key = (instance.category_id, get_version('schema'))
+	if key not in _compiled_fields:
+		prune(_compiled_fields, key[1])
+		_compiled_fields[key] = compile_fields(field_schema([instance.category_id])[instance.category_id])
+	
+	return _compiled_fields[key]
+
+def compile_fields(fields):
+	# generate a sorted dict of form fields corresponding to the given
+	# Field objects
 	fields_dict = SortedDict()
-	fields = list(instance.category.field_set.all())
-	fields += list(Field.objects.filter(category=None))
 	# this really could be refactored
 	for field in fields:
 		if field.field_type == Field.BOOLEAN_FIELD:
@@ -182,16 +211,12 @@ def ad_to_dict(instance):
 	# generate a dict of field => value pairs for the FieldValue model
 	# for the Ad instance
 	fields_dict = {}
-	fields = list(instance.category.field_set.all())
-	fields += list(Field.objects.filter(category=None))
-	for field in fields:
+	values = instance.fields_dict()
+	for field in field_schema([instance.category_id])[instance.category_id]:
 		if field.name == 'title':
 			fields_dict['title'] = instance.title
-		else:
-			try:
-				fields_dict[field.name] = field.fieldvalue_set.get(ad=instance).value
-			except FieldValue.DoesNotExist:
-				pass
+		elif values.has_key(field.name):
+			fields_dict[field.name] = values[field.name]
 	
 	return fields_dict
 
@@ -212,6 +237,7 @@ class AdForm(BaseForm):
 		BaseForm.__init__(self, data, files, auto_id, prefix, object_data,
 											error_class, label_suffix, empty_permitted)
 
+	@transaction.commit_on_success
 	def save(self, commit=True):
 		if not commit:
 			raise NotImplementedError("AdForm.save must commit it's changes.")
@@ -222,8 +248,16 @@ class AdForm(BaseForm):
 		cleaned_data = self.cleaned_data
 
 		# save fieldvalues for self.instance
-		fields = list(self.instance.category.field_set.all())
-		fields += list(Field.objects.filter(category=None))
+		fields = field_schema([self.instance.category_id])[self.instance.category_id]
+		
+		# load the existing values in one query, then insert and update in bulk
+		existing = {}
+		for fv in FieldValue.objects.filter(ad=self.instance):
+			existing[fv.field_id] = fv
+		created = []
+		updated = []
+		# field name => saved text, for the search index
+		values = {}
 		
 		for field in fields:
 			if field.enable_wysiwyg:
@@ -232,30 +266,46 @@ class AdForm(BaseForm):
 				value = unicode(cleaned_data[field.name])
 		
 			# strip words in settings.FORBIDDEN_WORDS
-			for word in settings.FORBIDDEN_WORDS.split(','):
-				value = value.replace(word, '')
+			value = strip_forbidden_words(value)
 			
 			# title is stored directly in the ad, unlike all other editable fields
 			if field.name == 'title':
 				self.instance.title = value
-				self.instance.save()
+				values['title'] = value
 			else:
-				# check to see if field.fieldvalue_set has a value with ad=self.instance
-				try:
-					# if it does, update
-					fv = field.fieldvalue_set.get(ad=self.instance)
-				except FieldValue.DoesNotExist:
-					# otherwise, create a new one
-					fv = field.fieldvalue_set.create(ad=self.instance)
+				if field.name == 'zip_code':
+					# look up the location once, for radius searches
+					self.instance.locate(value)
 				
 				if field.name.endswith('price'):
 					m = re.match('^\$?(\d{1,3},?(\d{3},?)*\d{3}(\.\d{0,2})?|\d{1,3}(\.\d{0,2})?|\.\d{1,2}?)$', value)
 					value = m.group(1)
-					value.replace(',', '')
+					value = value.replace(',', '')
 					value = '%.2f' % float(value)
 				
-				fv.value = value
-				fv.save()
+				values[field.name] = value
+				fv = existing.get(field.pk)
+				if fv is None:
+					fv = FieldValue(field=field, ad=self.instance, value=value)
+					created.append(fv)
+				elif fv.value != value:
+					fv.field = field
+					fv.value = value
+					updated.append(fv)
+				else:
+					continue
+				fv.update_index()
+		
+		save_field_values(created, updated)
+		self.instance.save()
+		
+		# update the keyword search index
+		get_backend().index(self.instance, values)
+		
+		# the values attached by Ad.fields() are out of date now
+		for attr in ('_fields_cache', '_fields_dict_cache'):
+			if hasattr(self.instance, attr):
+				delattr(self.instance, attr)
 		
 		return self.instance
 
@@ -0,0 +1,349 @@
+"""
+  $Id$
+
+Benchmarks for the hot paths: searching with each of the filter forms,
+sorting the results, building and saving an AdForm and the cron digest.
+
+seed() fills the database with a synthetic data set that only depends on
+its parameters (categories, fields per category, ads with their field
+values, zip codes, payments and digest subscribers).  run() then times
+every scenario: the first run after clearing the caches ('cold'), and the
+median of the following ones ('warm'), with the number of queries.  Each
+scenario runs in a process of its own, forked from the one that seeded the
+data, so that the peak memory reported for it (max_rss_kb, and
+rss_growth_kb above what the process started with) is its own.  The
+results are plain JSON, so that runs on different commits can be compared
+with compare().
+
+Use the benchmark management command, which runs all of this in a test
+database and with a cache of its own (see use_cache()).
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.db import connection, transaction
+from django.http import HttpRequest, QueryDict
+from django.utils import simplejson
+
+from classifieds.profiling import QueryProfile
+
+from models import Ad, Category, Field, FieldValue, Payment, Pricing, UserProfile, ZipCode, save_field_values
+from adform import AdForm, ad_to_dict
+from fulltext import get_backend
+from searchcache import search_cache
+from versions import bump_version
+import cron, fulltext, geo, pagecache, searchcache, sitemaps, versions, views
+
+import datetime, os, random, resource, traceback
+
+WORDS = ('apartment', 'bicycle', 'carpenter', 'desk', 'guitar', 'house', 'laptop', 'nurse',
+         'piano', 'sofa', 'teacher', 'truck', 'welder', 'camera', 'garden', 'office')
+TYPES = ('full time', 'part time', 'contract', 'temporary', 'internship')
+
+DEFAULTS = {
+	'categories': 3,
+	'fields': 6,
+	'ads': 2000,
+	'zipcodes': 2000,
+	'payments': 200,
+	'subscribers': 200,
+	'repeat': 5,
+	'seed': 1,
+}
+
+class Dataset(object):
+	"""
+	What the scenarios need to know about the seeded data.
+	"""
+	def __init__(self, user, categories, ad_ids, zipcodes):
+		self.user = user
+		self.categories = categories
+		self.ad_ids = ad_ids
+		self.zipcodes = zipcodes
+
+def seed(parameters):
+	rng = random.Random(parameters['seed'])
+	site = Site.objects.get_current()
+	now = datetime.datetime.now()
+
+	user = User.objects.create_user('benchmark', 'benchmark@example.com', 'benchmark')
+	user.first_name = 'Bench'
+	user.save()
+	for i in range(parameters['subscribers']):
+		subscriber = User.objects.create_user('subscriber%d' % i, 'subscriber%d@example.com' % i)
+		subscriber.first_name = rng.choice(('Ann', 'Bob', 'Cid', 'Dee', 'Eve'))
+		subscriber.save()
+		UserProfile.objects.create(user=subscriber, receives_new_posting_notices=True, receives_newsletter=False)
+
+	zipcodes = []
+	for i in range(parameters['zipcodes']):
+		zipcode = ZipCode.objects.create(zipcode=10000 + i, latitude=rng.uniform(25.0, 49.0), longitude=rng.uniform(-124.0, -67.0), city='City %d' % i, state='NY')
+		zipcodes.append(zipcode.zipcode)
+	geo.reset_index()
+
+	Field.objects.create(name='title', label='Title', field_type=Field.CHAR_FIELD, max_length=255, required=True)
+	categories = []
+	for i in range(parameters['categories']):
+		category = Category.objects.create(site=site, template_prefix='jobs', name='Benchmark %d' % i,
+		                                   contact_form_upload_max_size=0, contact_form_upload_file_extensions='',
+		                                   images_max_count=0, images_max_width=640, images_max_height=480,
+		                                   images_max_size=0, description='', sortby_fields='price,years')
+		Field.objects.create(category=category, name='price', label='Price', field_type=Field.CHAR_FIELD)
+		Field.objects.create(category=category, name='zip_code', label='Zip Code', field_type=Field.CHAR_FIELD)
+		Field.objects.create(category=category, name='type', label='Type', field_type=Field.SELECT_FIELD, options=','.join(TYPES))
+		Field.objects.create(category=category, name='years', label='Years', field_type=Field.INTEGER_FIELD)
+		Field.objects.create(category=category, name='description', label='Description', field_type=Field.TEXT_FIELD)
+		for j in range(5, parameters['fields']):
+			Field.objects.create(category=category, name='extra%d' % j, label='Extra %d' % j, field_type=Field.CHAR_FIELD)
+		categories.append(category)
+
+	fields = {}
+	for field in Field.objects.filter(category__in=categories):
+		fields.setdefault(field.category_id, []).append(field)
+
+	pricing = Pricing.objects.create(length=30, price='10.00')
+	backend = get_backend()
+	ad_ids = []
+	for i in range(parameters['ads']):
+		category = categories[i % len(categories)]
+		words = rng.sample(WORDS, 3)
+		ad = Ad(category=category, user=user, expires_on=now + datetime.timedelta(days=rng.randint(1, 60)), active=True, title=' '.join(words))
+		if i < parameters['payments']:
+			ad.featured_until = now + datetime.timedelta(days=30)
+			ad.featured = True
+		values = {
+			'price': '%d.00' % rng.randint(1, 5000),
+			'zip_code': str(rng.choice(zipcodes)),
+			'type': rng.choice(TYPES),
+			'years': str(rng.randint(0, 30)),
+			'description': ' '.join([rng.choice(WORDS) for k in range(40)]),
+		}
+		for j in range(5, parameters['fields']):
+			values['extra%d' % j] = rng.choice(WORDS)
+		ad.locate(values['zip_code'])
+		ad.save()
+
+		created = []
+		for field in fields[category.pk]:
+			fv = FieldValue(field=field, ad=ad, value=values[field.name])
+			fv.update_index()
+			created.append(fv)
+		save_field_values(created, [])
+		values['title'] = ad.title
+		backend.index(ad, values)
+
+		if i < parameters['payments']:
+			Payment.objects.create(ad=ad, pricing=pricing)
+		ad_ids.append(ad.pk)
+		if i % 500 == 499:
+			transaction.commit_unless_managed()
+	transaction.commit_unless_managed()
+
+	return Dataset(user, categories, ad_ids, zipcodes)
+
+def make_request(user, query='', session=None):
+	"""
+	A GET request for calling the views directly.
+	"""
+	request = HttpRequest()
+	request.method = 'GET'
+	request.GET = QueryDict(query)
+	request.POST = QueryDict('')
+	request.META = {'SERVER_NAME': 'testserver', 'SERVER_PORT': '80'}
+	request.path = '/'
+	request.user = user
+	if session is None:
+		session = {}
+	request.session = session
+	return request
+
+# what the search form posts when nothing is filled in
+EMPTY_SEARCH = {'lowest': '', 'highest': '', 'zip_code': '', 'zip_range': '', 'keywords': '', 'type': ''}
+
+def search_scenario(filters, query=''):
+	def scenario(dataset):
+		# the stored search, as search_results keeps it in the session
+		search = {}
+		data = EMPTY_SEARCH.copy()
+		data.update(filters(dataset))
+		for name, value in data.items():
+			search[name] = [value]
+		category = dataset.categories[0]
+		request = make_request(dataset.user, query, {'search': search})
+		views.search_results(request, str(category.pk))
+	return scenario
+
+def adform_construct(dataset):
+	ad = Ad.objects.get(pk=dataset.ad_ids[0])
+	form = AdForm(ad)
+	form.as_p()
+
+def adform_save(dataset):
+	ad = Ad.objects.get(pk=dataset.ad_ids[1])
+	data = ad_to_dict(ad)
+	data['price'] = str(int(float(data['price'])) % 5000 + 1) + '.00'
+	form = AdForm(ad, data)
+	if not form.is_valid():
+		raise ValueError('the benchmark ad does not validate: %r' % form.errors)
+	form.save()
+
+def cron_digest(dataset):
+	cron.send_digest()
+
+def zip_filter(dataset):
+	return {'zip_code': str(dataset.zipcodes[0]), 'zip_range': '300'}
+
+def keyword_filter(dataset):
+	return {'keywords': 'guitar'}
+
+SCENARIOS = (
+	('search', search_scenario(lambda dataset: {})),
+	('search_price', search_scenario(lambda dataset: {'lowest': '100', 'highest': '1000'})),
+	('search_zip', search_scenario(zip_filter)),
+	('search_keywords', search_scenario(keyword_filter)),
+	('search_select', search_scenario(lambda dataset: {'type': 'contract'})),
+	('sort_created_on', search_scenario(lambda dataset: {}, 'sort=created_on&order=desc')),
+	('sort_price', search_scenario(lambda dataset: {}, 'sort=price&order=asc')),
+	('sort_years', search_scenario(lambda dataset: {}, 'sort=years&order=desc')),
+	('sort_distance', search_scenario(zip_filter, 'sort=distance&order=asc')),
+	('sort_relevance', search_scenario(keyword_filter, 'sort=relevance&order=desc')),
+	('page_5', search_scenario(lambda dataset: {}, 'page=5')),
+	('adform_construct', adform_construct),
+	('adform_save', adform_save),
+	('cron_digest', cron_digest),
+)
+
+# the modules that keep things in the Django cache
+CACHE_MODULES = (fulltext, pagecache, searchcache, sitemaps, versions)
+
+def use_cache(cache):
+	"""
+	Points the modules that use the Django cache at the given one, so that
+	the versions, facets and pages of the benchmark data don't end up in
+	the site's cache, which may be shared with the live site.  Returns what
+	restore_cache() needs to undo it.
+	"""
+	old = [(module, module.cache) for module in CACHE_MODULES]
+	for module in CACHE_MODULES:
+		module.cache = cache
+	return old
+
+def restore_cache(old):
+	for module, cache in old:
+		module.cache = cache
+
+def clear_caches(dataset):
+	search_cache.clear()
+	bump_version('schema')
+	for category in dataset.categories:
+		bump_version('category:%d' % category.pk)
+
+def measure(scenario, dataset):
+	profile = QueryProfile()
+	profile.start()
+	try:
+		scenario(dataset)
+	finally:
+		profile.stop()
+	return {'time': round(profile.duration, 4), 'queries': len(profile.queries)}
+
+def measure_scenario(scenario, dataset, repeat):
+	clear_caches(dataset)
+	cold = measure(scenario, dataset)
+	warm = [measure(scenario, dataset) for i in range(max(repeat - 1, 1))]
+	times = [result['time'] for result in warm]
+	times.sort()
+	return {'cold': cold, 'warm': {'time': times[len(times) / 2], 'queries': warm[-1]['queries']}}
+
+# see detach_connection
+_parent_connection = None
+
+def detach_connection():
+	"""
+	Makes a forked process open a database connection of its own instead
+	of sharing the parent's socket.  An in-memory SQLite database only
+	exists in the connection, which the process has a copy of, so it is
+	kept.
+	"""
+	global _parent_connection
+	if connection.settings_dict['NAME'] != ':memory:':
+		# the connection object must outlive the process: closing it would
+		# close the parent's connection too (os._exit skips finalizers)
+		_parent_connection = connection.connection
+		connection.connection = None
+
+def in_child(function, *args):
+	"""
+	Calls function, which returns a dict, in a forked process and returns
+	that dict with the peak memory of the process.
+	"""
+	read_fd, write_fd = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read_fd)
+		status = 1
+		try:
+			try:
+				detach_connection()
+				# a forked process starts with the memory of its parent
+				start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+				result = function(*args)
+				result['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+				result['rss_growth_kb'] = result['max_rss_kb'] - start
+				f = os.fdopen(write_fd, 'w')
+				f.write(simplejson.dumps(result))
+				f.close()
+				status = 0
+			except:
+				traceback.print_exc()
+		finally:
+			os._exit(status)
+
+	os.close(write_fd)
+	f = os.fdopen(read_fd)
+	try:
+		data = f.read()
+	finally:
+		f.close()
+	pid, status = os.waitpid(pid, 0)
+	if status != 0:
+		raise RuntimeError('the benchmark process failed')
+	return simplejson.loads(data)
+
+def run(dataset, repeat=DEFAULTS['repeat'], only=None):
+	"""
+	Times the scenarios (all, or the names in only) and returns a list of
+	result dicts.
+	"""
+	old_backend = getattr(settings, 'EMAIL_BACKEND', None)
+	settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+	results = []
+	try:
+		for name, scenario in SCENARIOS:
+			if only and name not in only:
+				continue
+			result = in_child(measure_scenario, scenario, dataset, repeat)
+			result['name'] = name
+			results.append(result)
+	finally:
+		settings.EMAIL_BACKEND = old_backend
+	return results
+
+def compare(old, new):
+	"""
+	Lines comparing two benchmark reports (as returned by the benchmark
+	command) scenario by scenario.
+	"""
+	old_results = dict([(result['name'], result) for result in old['scenarios']])
+	lines = ['%-20s %10s %10s %7s %12s %12s' % ('scenario', 'before', 'after', 'ratio', 'queries', 'cold queries')]
+	for result in new['scenarios']:
+		before = old_results.get(result['name'])
+		if before is None:
+			lines.append('%-20s %10s %9.1fms' % (result['name'], '-', result['warm']['time'] * 1000))
+			continue
+		ratio = before['warm']['time'] and result['warm']['time'] / before['warm']['time'] or 0
+		lines.append('%-20s %8.1fms %8.1fms %6.2fx %5d -> %-4d %5d -> %-4d' % (
+			result['name'], before['warm']['time'] * 1000, result['warm']['time'] * 1000, ratio,
+			before['warm']['queries'], result['warm']['queries'], before['cold']['queries'], result['cold']['queries']))
+	return lines
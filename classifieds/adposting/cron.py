@@ -3,66 +3,211 @@
 """
 
 from django.template import Context, loader
+from django.utils.html import conditional_escape
 from django.utils.translation import ugettext as _
 from django.contrib.auth.models import User
 
-from django.core.mail import send_mass_mail
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
 
-from django.contrib.sites.models import Site
 
-from classifieds.adposting.models import Ad
+from classifieds.adposting.models import Ad, AdImage, AdImageRendition, JobCheckpoint, Payment, PricingOptions, load_fields
 
-from options import from_email, notice_posting_new, notice_posting_expires
+from options import current_site, from_email, notice_posting_new, notice_posting_expires
+from versions import bump_version
 
 import datetime
 
-def run():
-	yesterday = datetime.datetime.today() - datetime.timedelta(days=int(notice_posting_new()))
-	postings = Ad.objects.filter(created_on__gt=yesterday)
-	
-	# get subscriber list
-	subscribers = User.objects.filter(userprofile__receives_new_posting_notices=True)
-	
-	emails = []
+# number of emails handed to the mail backend at a time
+EMAIL_BATCH_SIZE = 100
+# number of ads notified or purged at a time
+AD_BATCH_SIZE = 200
+# stands in for the subscriber's first name in the rendered digest
+FIRST_NAME_MARKER = u'\ufdd0first_name\ufdd0'
+
+def send_in_batches(messages, batch_size=EMAIL_BATCH_SIZE):
+	"""
+	Sends the EmailMessages yielded by messages over a single connection,
+	batch_size at a time, so that they never all have to be in memory.
+	Returns the number of messages sent.
+	"""
+	connection = get_connection()
+	connection.open()
+	sent = 0
+	try:
+		batch = []
+		for message in messages:
+			message.connection = connection
+			batch.append(message)
+			if len(batch) >= batch_size:
+				sent += connection.send_messages(batch) or 0
+				batch = []
+		if batch:
+			sent += connection.send_messages(batch) or 0
+	finally:
+		connection.close()
+	return sent
+
+def new_posting_notices(postings, site):
+	email_template = loader.get_template('adposting/email/newpostings.txt')
+	subject = _('New ads posted on ') + site.name
+	sender = from_email()
 	
-	for subscriber in subscribers:
-		# 1. render context to email template
-		email_template = loader.get_template('adposting/email/newpostings.txt')
-		context = Context({'postings': postings, 'user': subscriber, 'site': Site.objects.get_current()})
-		email_contents = email_template.render(context)
-		emails.append( (_('New ads posted on ') + Site.objects.get_current().name,
-		                email_contents,
-		                from_email(),
-		                [subscriber.email],
-		               )
-		             )
-
-	# 2. send emails
-	send_mass_mail(emails)
+	# the digest is the same for everyone but the greeting, so it is
+	# rendered once and each subscriber's (escaped) first name filled in
+	context = Context({'postings': postings, 'user': {'first_name': FIRST_NAME_MARKER}, 'site': site})
+	rendered = email_template.render(context)
+	subscribers = User.objects.filter(userprofile__receives_new_posting_notices=True).values_list('first_name', 'email')
+	for first_name, email in subscribers.iterator():
+		yield EmailMessage(subject, rendered.replace(FIRST_NAME_MARKER, conditional_escape(first_name)), sender, [email])
+
+def expiring_notices(postings, site):
+	email_template = loader.get_template('adposting/email/expiring.txt')
+	subject = _('Your ad on ') + site.name + _(' is about to expire.')
+	sender = from_email()
+	for posting in postings:
+		context = Context({'posting': posting, 'user': posting.user, 'site': site})
+		yield EmailMessage(subject, email_template.render(context), sender, [posting.user.email])
+
+def send_expiry_notices(site, until, batch_size=AD_BATCH_SIZE):
+	"""
+	Tells the owners of the active ads that expire before until, once per
+	ad (Ad.make_payment clears the flag again).  Returns the number of ads.
+	"""
+	notified = 0
+	last_pk = 0
+	now = datetime.datetime.now()
+	while True:
+		postings = list(Ad.objects.filter(active=True, expiry_notice_sent=False, expires_on__gt=now, expires_on__lt=until, pk__gt=last_pk).select_related('user', 'category__site').order_by('pk')[:batch_size])
+		if not postings:
+			break
+		send_in_batches(expiring_notices(postings, site))
+		Ad.objects.filter(pk__in=[posting.pk for posting in postings]).update(expiry_notice_sent=True)
+		transaction.commit_unless_managed()
+		notified += len(postings)
+		last_pk = postings[-1].pk
+	return notified
+
+@transaction.commit_on_success
+def purge_batch(pks, checkpoint):
+	"""
+	Deletes the ads with the given pks and everything that belongs to them,
+	and moves the checkpoint past them, in one transaction.  Returns the
+	names of the image files they used.
+	"""
+	images = AdImage.objects.filter(ad__in=pks)
+	files = [name for name in images.values_list('full_photo', flat=True) if name]
+	files += list(AdImageRendition.objects.filter(image__in=images.values('pk').query).values_list('photo', flat=True).distinct())
 	
-	tomorrow = datetime.datetime.today() + datetime.timedelta(days=int(notice_posting_expires()))
-	expiring_postings = Ad.objects.filter(expires_on__lt=tomorrow)
-	emails = []
+	Ad.objects.filter(pk__in=pks).delete()
+	checkpoint.position = pks[-1]
+	checkpoint.save()
+	return files
+
+def purge_expired(before, batch_size=AD_BATCH_SIZE):
+	"""
+	Deletes the ads that expired before the given date, batch_size at a
+	time, with their image files.  The last deleted pk is kept in a
+	JobCheckpoint, so that a run that gets killed continues from there.
+	Returns the number of ads deleted.
+	"""
+	checkpoint = JobCheckpoint.get('adposting.purge')
+	purged = 0
+	while True:
+		pks = list(Ad.objects.filter(expires_on__lt=before, pk__gt=checkpoint.position).order_by('pk').values_list('pk', flat=True)[:batch_size])
+		if not pks:
+			break
+		files = purge_batch(pks, checkpoint)
+		purged += len(pks)
+		
+		# the files are only removed once the rows are gone for good;
+		# renditions are named after their contents and may be shared
+		for name in files:
+			if AdImageRendition.objects.filter(photo=name).count() == 0 and \
+			   AdImage.objects.filter(full_photo=name).count() == 0:
+				AdImage._meta.get_field('full_photo').storage.delete(name)
 	
-	for posting in expiring_postings:
-		# 1. render context to email template
-		email_template = loader.get_template('adposting/email/expiring.txt')
-		context = Context({'posting': posting, 'user': posting.user, 'site': Site.objects.get_current()})
-		email_contents = email_template.render(context)
-		emails.append( (_('Your ad on ') + Site.objects.get_current().name + _(' is about to expire.'),
-		                email_contents,
-		                from_email(),
-		                [posting.user.email],
-		               )
-		             )
-
-	# 2. send emails
-	send_mass_mail(emails)
+	# start from the beginning next time
+	checkpoint.position = 0
+	checkpoint.save()
+	transaction.commit_unless_managed()
+	return purged
+
+def update_featured(batch_size=AD_BATCH_SIZE):
+	"""
+	Keeps Ad.featured in step with featured_until: sets it on the ads whose
+	featured period is running and clears it once the period is over.  update() sends no signals, so the cached searches and pages
+	of the ads are dropped here.  Returns the number of ads changed.
+	"""
+	now = datetime.datetime.now()
+	changed = 0
+	for featured, ads in ((True, Ad.objects.filter(featured=False, featured_until__gte=now)),
+	                      (False, Ad.objects.filter(featured=True).exclude(featured_until__gte=now))):
+		while True:
+			rows = list(ads.values_list('pk', 'category_id')[:batch_size])
+			if not rows:
+				break
+			Ad.objects.filter(pk__in=[pk for pk, category_id in rows]).update(featured=featured)
+			transaction.commit_unless_managed()
+			for category_id in set([category_id for pk, category_id in rows]):
+				bump_version('category:%d' % category_id)
+			for pk, category_id in rows:
+				bump_version('ad:%d' % pk)
+			changed += len(rows)
+	return changed
+
+def backfill_featured():
+	"""
+	Sets featured_until on the ads that were paid for as featured listings
+	before it existed, from their completed payments, the way
+	Ad.make_payment does: each payment adds its length to the end of the
+	featured period that is still running, or to the payment date.  Then
+	runs update_featured().  Returns the number of ads given a
+	featured_until.
+	"""
+	payments = Payment.objects.filter(options__name=PricingOptions.FEATURED_LISTING, paypal__payment_status='Completed',
+	                                  paypal__payment_date__isnull=False, ad__featured_until__isnull=True)
+	# ad id => end of its featured period
+	until = {}
+	for payment in payments.select_related('paypal', 'pricing').order_by('paypal__payment_date').iterator():
+		featured_from = payment.paid_on
+		if payment.ad_id in until and until[payment.ad_id] > featured_from:
+			featured_from = until[payment.ad_id]
+		until[payment.ad_id] = featured_from + datetime.timedelta(days=payment.pricing.length)
+	for pk, featured_until in until.items():
+		Ad.objects.filter(pk=pk).update(featured_until=featured_until)
+	transaction.commit_unless_managed()
+	update_featured()
+	return len(until)
+
+def send_digest():
+	site = current_site()
+	yesterday = datetime.datetime.today() - datetime.timedelta(days=notice_posting_new())
+	# evaluated once, with their categories and field values, for all emails
+	postings = load_fields(Ad.objects.filter(created_on__gt=yesterday).select_related('category'))
 	
+	return send_in_batches(new_posting_notices(postings, site))
+
+def notify_expiring():
+	tomorrow = datetime.datetime.today() + datetime.timedelta(days=notice_posting_expires())
+	return send_expiry_notices(current_site(), tomorrow)
+
+def purge():
 	# delete old ads
-	yesterday = datetime.datetime.today() - datetime.timedelta(days=int(notice_posting_expires()))
-	Ad.objects.filter(expires_on__lt=yesterday).delete()
+	yesterday = datetime.datetime.today() - datetime.timedelta(days=notice_posting_expires())
+	return purge_expired(yesterday)
+
+# the jobs for classifieds/cron.py: (name, function returning the number of rows done)
+jobs = (
+	('digest', send_digest),
+	('expiring', notify_expiring),
+	('purge', purge),
+	('featured', update_featured),
+)
+
+def run():
+	for name, job in jobs:
+		job()
 
 if __name__ == '__main__':
 	run()
-
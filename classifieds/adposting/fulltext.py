@@ -0,0 +1,210 @@
+"""
+  $Id$
+
+Full text search backends for the keyword search (search.MultiForm).
+
+settings.SEARCH_BACKEND is the dotted path of the backend class:
+
+ - classifieds.adposting.fulltext.IndexBackend (the default) keeps an
+   inverted index of the ads in the SearchTerm table.  It is updated from
+   AdForm.save(), matches every keyword as a prefix and ranks the results
+   with BM25, weighting the fields by settings.SEARCH_FIELD_WEIGHTS.  It
+   works on any database.
+
+ - classifieds.adposting.fulltext.MySQLBackend uses MySQL's MATCH AGAINST
+   on Ad.title and FieldValue.value, which needs FULLTEXT indexes on both.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q, Count, Sum
+from django.utils.hashcompat import md5_constructor
+from django.utils.importlib import import_module
+
+from versions import bump_version
+
+import math, re
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# field name => weight of the terms found in it
+FIELD_WEIGHTS = getattr(settings, 'SEARCH_FIELD_WEIGHTS', {'title': 3.0})
+
+# seconds the document count and average length, and the number of ads
+# matching each keyword, are cached
+STATS_TIMEOUT = 60 * 60
+
+def tokenize(text):
+	"""
+	Returns the lower case words (letters and digits) in text, ignoring
+	HTML tags.
+	"""
+	text = re.sub(r'<[^>]*>', ' ', text)
+	return [term[:64] for term in re.findall(r'[^\W_]+', text.lower(), re.UNICODE)]
+
+class SearchBackend(object):
+	def index(self, ad, values):
+		"""
+		(Re)indexes ad; values is a dict of field name => text and includes
+		the title.
+		"""
+		raise NotImplementedError
+
+	def remove(self, ad_pk):
+		"""
+		Drops the ad with the given pk from the index.
+		"""
+		raise NotImplementedError
+
+	def filter(self, qs, keywords):
+		"""
+		Returns qs restricted to the ads that match keywords in their title
+		or any of their field values.
+		"""
+		raise NotImplementedError
+
+	def relevance(self, keywords):
+		"""
+		Returns (sql, params) for a select that ranks the ads matching
+		keywords, or None if the backend can't rank.
+		"""
+		return None
+
+class MySQLBackend(SearchBackend):
+	def index(self, ad, values):
+		pass
+
+	def remove(self, ad_pk):
+		pass
+
+	def filter(self, qs, keywords):
+		from classifieds.adposting.models import FieldValue
+		fvs = FieldValue.objects.filter(value__search=keywords)
+		return qs.filter(Q(pk__in=fvs.values('ad').query) | Q(title__search=keywords))
+
+class IndexBackend(SearchBackend):
+	def stats(self):
+		"""
+		Returns the number of indexed ads and their average length.
+		"""
+		from classifieds.adposting.models import SearchTerm
+		stats = cache.get('fulltext:stats')
+		if stats is None:
+			totals = SearchTerm.objects.aggregate(length=Sum('tf'), documents=Count('ad', distinct=True))
+			if totals['documents']:
+				stats = (totals['documents'], totals['length'] / totals['documents'])
+			else:
+				stats = (0, 0.0)
+			cache.set('fulltext:stats', stats, STATS_TIMEOUT)
+		return stats
+
+	def document_frequency(self, term):
+		"""
+		Returns the number of indexed ads with a term that starts with term.
+		"""
+		from classifieds.adposting.models import SearchTerm
+		key = 'fulltext:df:' + md5_constructor(term.encode('utf-8')).hexdigest()
+		matches = cache.get(key)
+		if matches is None:
+			matches = SearchTerm.objects.filter(term__startswith=term).values('ad').distinct().count()
+			cache.set(key, matches, STATS_TIMEOUT)
+		return matches
+
+	def index(self, ad, values):
+		from classifieds.adposting.models import SearchTerm
+		tfs = {}
+		length = 0.0
+		for name, text in values.items():
+			weight = FIELD_WEIGHTS.get(name, 1.0)
+			for term in tokenize(text):
+				tfs[term] = tfs.get(term, 0.0) + weight
+				length += weight
+
+		documents, average_length = self.stats()
+		if not average_length:
+			average_length = length or 1.0
+
+		# the tf part of BM25 only depends on the ad, so it is stored with
+		# the term and the query only has to multiply it with the idf
+		rows = []
+		for term, tf in tfs.items():
+			score = tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / average_length))
+			rows.append((ad.pk, term, tf, score))
+
+		self.remove(ad.pk)
+		if rows:
+			qn = connection.ops.quote_name
+			cursor = connection.cursor()
+			cursor.executemany('INSERT INTO %s (%s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s)' % (qn(SearchTerm._meta.db_table), qn('ad_id'), qn('term'), qn('tf'), qn('score')), rows)
+			transaction.set_dirty()
+
+	def remove(self, ad_pk):
+		from classifieds.adposting.models import SearchTerm
+		SearchTerm.objects.filter(ad=ad_pk).delete()
+
+	def filter(self, qs, keywords):
+		from classifieds.adposting.models import SearchTerm
+		terms = tokenize(keywords)
+		if not terms:
+			return qs.none()
+
+		# every keyword has to match the start of a term of the ad
+		for term in terms:
+			qs = qs.filter(pk__in=SearchTerm.objects.filter(term__startswith=term).values('ad').query)
+		return qs
+
+	def relevance(self, keywords):
+		terms = tokenize(keywords)
+		if not terms:
+			return None
+
+		documents, average_length = self.stats()
+		cases = []
+		params = []
+		for term in terms:
+			matches = self.document_frequency(term)
+			idf = math.log(1 + (documents - matches + 0.5) / (matches + 0.5))
+			# tokenize() leaves no LIKE wildcards in the term
+			cases.append('CASE WHEN adposting_searchterm.term LIKE %s THEN adposting_searchterm.score * %s ELSE 0 END')
+			params += [term + '%', idf]
+
+		sql = '(SELECT SUM(' + ' + '.join(cases) + ') FROM adposting_searchterm WHERE adposting_searchterm.ad_id = adposting_ad.id)'
+		return (sql, params)
+
+def rebuild(batch_size=500):
+	"""
+	Reindexes all active ads, e.g. after switching backends or for the ads
+	posted before the index existed, and returns how many there were.
+	"""
+	from classifieds.adposting.models import Ad, load_fields
+	backend = get_backend()
+	indexed = 0
+	last_pk = 0
+	while True:
+		ads = load_fields(Ad.objects.filter(active=True, pk__gt=last_pk).order_by('pk')[:batch_size])
+		if not ads:
+			break
+		for ad in ads:
+			values = ad.fields_dict().copy()
+			values['title'] = ad.title
+			backend.index(ad, values)
+		transaction.commit_unless_managed()
+		# drop the cached searches that missed these ads
+		for category_id in set([ad.category_id for ad in ads]):
+			bump_version('category:%d' % category_id)
+		indexed += len(ads)
+		last_pk = ads[-1].pk
+	return indexed
+
+_backend = None
+
+def get_backend():
+	global _backend
+	if _backend is None:
+		path = getattr(settings, 'SEARCH_BACKEND', 'classifieds.adposting.fulltext.IndexBackend')
+		module, name = path.rsplit('.', 1)
+		_backend = getattr(import_module(module), name)()
+	return _backend
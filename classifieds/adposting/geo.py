@@ -0,0 +1,127 @@
+"""
+  $Id$
+
+In-memory spatial index over the ZipCode table.
+
+The whole table (about 40k rows) is loaded once per process into a grid of
+one degree cells.  A radius query only looks at the cells that overlap the
+bounding box of the circle and computes the exact great circle distance for
+the zip codes in them, so it needs neither a database round-trip nor the
+MySQL GetDistance function.
+"""
+
+import math
+
+EARTH_RADIUS = 3958.76 # miles
+
+# miles per degree of latitude
+MILES_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+def distance(lat1, lon1, lat2, lon2):
+	"""
+	Great circle distance between two points in miles (haversine).
+	"""
+	lat1, lon1, lat2, lon2 = [math.radians(x) for x in (lat1, lon1, lat2, lon2)]
+	a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+	return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+def longitude_span(latitude, radius):
+	"""
+	Degrees of longitude that radius miles span at the given latitude.
+	"""
+	cos_lat = math.cos(math.radians(min(89.0, abs(latitude))))
+	return radius / (MILES_PER_DEGREE * cos_lat)
+
+def distance_sql(latitude, longitude):
+	"""
+	SQL for the squared distance of an ad from the given point, in degrees
+	of latitude.  The longitude difference is scaled for the point's
+	latitude; over the distances people search this is within a fraction
+	of a percent of the great circle distance, and it only takes arithmetic
+	so that any database can evaluate it.  The coordinates are floats and
+	are put into the SQL directly.
+	"""
+	cos_lat = math.cos(math.radians(latitude))
+	return '((adposting_ad.latitude - %.6f) * (adposting_ad.latitude - %.6f) + (adposting_ad.longitude - %.6f) * (adposting_ad.longitude - %.6f) * %.6f)' % (latitude, latitude, longitude, longitude, cos_lat * cos_lat)
+
+class ZipCodeIndex(object):
+	def __init__(self, rows):
+		# zipcode => (latitude, longitude)
+		self.points = {}
+		# (floor(latitude), floor(longitude)) => [(zipcode, latitude, longitude)]
+		self.cells = {}
+		for zipcode, latitude, longitude in rows:
+			self.points[zipcode] = (latitude, longitude)
+			cell = (int(math.floor(latitude)), int(math.floor(longitude)))
+			self.cells.setdefault(cell, []).append((zipcode, latitude, longitude))
+
+	def location(self, zipcode):
+		"""
+		Returns the (latitude, longitude) of zipcode, or None if unknown.
+		"""
+		return self.points.get(zipcode)
+
+	def nearby(self, latitude, longitude, radius):
+		"""
+		Returns a list of (distance, zipcode) tuples for all zip codes within
+		radius miles of the given point, closest first.
+		"""
+		lat_span = radius / MILES_PER_DEGREE
+		lon_span = longitude_span(latitude, radius)
+		results = []
+		for lat_cell in range(int(math.floor(latitude - lat_span)), int(math.floor(latitude + lat_span)) + 1):
+			for lon_cell in range(int(math.floor(longitude - lon_span)), int(math.floor(longitude + lon_span)) + 1):
+				for zipcode, lat, lon in self.cells.get((lat_cell, lon_cell), ()):
+					d = distance(latitude, longitude, lat, lon)
+					if d <= radius:
+						results.append((d, zipcode))
+		results.sort()
+		return results
+
+_index = None
+
+def get_index():
+	"""
+	Returns the process wide ZipCodeIndex, loading it on first use.
+	"""
+	global _index
+	if _index is None:
+		from classifieds.adposting.models import ZipCode
+		_index = ZipCodeIndex(ZipCode.objects.values_list('zipcode', 'latitude', 'longitude').iterator())
+	return _index
+
+def locate_ads(batch_size=500):
+	"""
+	Sets the location of the ads that have none yet from their stored zip
+	code, e.g. for the ads posted before radius searches used
+	Ad.latitude and Ad.longitude.  Returns the number of ads located.
+	"""
+	from django.db import transaction
+	from classifieds.adposting.models import Ad, FieldValue
+	from classifieds.adposting.versions import bump_version
+	located = 0
+	last_pk = 0
+	while True:
+		ads = list(Ad.objects.filter(latitude__isnull=True, pk__gt=last_pk).order_by('pk').values_list('pk', 'category_id')[:batch_size])
+		if not ads:
+			break
+		zip_codes = dict(FieldValue.objects.filter(ad__in=[pk for pk, category_id in ads], field__name='zip_code').values_list('ad', 'value'))
+		categories = set()
+		for pk, category_id in ads:
+			ad = Ad(pk=pk)
+			ad.locate(zip_codes.get(pk))
+			if ad.latitude is not None:
+				Ad.objects.filter(pk=pk).update(latitude=ad.latitude, longitude=ad.longitude)
+				categories.add(category_id)
+				located += 1
+		transaction.commit_unless_managed()
+		# update() sends no signals; drop the cached searches
+		for category_id in categories:
+			bump_version('category:%d' % category_id)
+		last_pk = ads[-1][0]
+	return located
+
+def reset_index(sender=None, **kwargs):
+	# zip codes hardly ever change, but reload them if they do (see signals.py)
+	global _index
+	_index = None
@@ -0,0 +1,65 @@
+"""
+  $Id$
+
+Background processing of uploaded ad images.
+
+Saving an ad only stores the uploaded files and marks the images as not
+processed; this worker shrinks them to the category's maximum size and
+generates the thumbnails.  The AdImage table doubles as the job queue, so
+schedule this script as often as needed:
+
+  python images.py
+"""
+
+from classifieds.adposting.models import AdImage
+
+import logging
+
+logger = logging.getLogger('classifieds.images')
+
+# images processed per query
+BATCH_SIZE = 50
+
+def queue_images(images):
+	"""
+	Marks the given (new or replaced) images for processing.
+	"""
+	pks = [image.pk for image in images if image.full_photo]
+	if pks:
+		AdImage.objects.filter(pk__in=pks).update(processed=False)
+
+def process_pending(limit=BATCH_SIZE):
+	"""
+	Processes up to limit pending images and returns how many there were.
+	"""
+	images = list(AdImage.objects.filter(processed=False).exclude(full_photo='').select_related('ad__category').order_by('pk')[:limit])
+	for image in images:
+		try:
+			image.process()
+		except Exception:
+			# the file is missing, truncated, not an image or too large to
+			# decode; retrying won't help, and leaving it pending would stall
+			# the queue behind it
+			logger.exception('could not process image %d (%s)', image.pk, image.full_photo.name)
+			AdImage.objects.filter(pk=image.pk).update(processed=True)
+	
+	return len(images)
+
+def run():
+	"""
+	Processes all pending images and returns how many there were.
+	"""
+	total = 0
+	while True:
+		count = process_pending()
+		total += count
+		if count < BATCH_SIZE:
+			return total
+
+# the jobs for classifieds/cron.py
+jobs = (
+	('images', run),
+)
+
+if __name__ == '__main__':
+	run()
@@ -0,0 +1,93 @@
+"""
+  $Id$
+
+Keyset (cursor) pagination for ad listings.
+
+Instead of an OFFSET, each page link carries the sort values of the last ad
+on the current page: whether it is featured, its sort key and its id.  The
+next page is then everything that sorts after that tuple, so page 100 costs
+the same as page 1, and no count() is needed.
+"""
+
+from django.utils import simplejson
+
+import base64, datetime, time
+
+def encode_cursor(featured, key, pk):
+	if isinstance(key, datetime.datetime):
+		key = ['d', str(key)]
+	else:
+		key = ['v', key]
+	return base64.urlsafe_b64encode(simplejson.dumps([int(featured)] + key + [pk]))
+
+def decode_cursor(cursor):
+	"""
+	Returns the (featured, key, pk) tuple encoded in cursor, or None if
+	the cursor is empty or can't be decoded.
+	"""
+	try:
+		featured, kind, key, pk = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+		if kind == 'd':
+			date, micro = (key.split('.') + ['0'])[:2]
+			key = datetime.datetime(*time.strptime(date, '%Y-%m-%d %H:%M:%S')[:6]).replace(microsecond=int(micro))
+		return (int(featured), key, int(pk))
+	except (AttributeError, TypeError, ValueError):
+		# e.g. a cursor that was tampered with
+		return None
+
+def after_cursor(qs, cursor, featured_sql, featured_params, sort_sql, sort_params, descending):
+	"""
+	Restricts qs to the rows that sort after the given cursor tuple, for
+	listings ordered by featured first, then sort_sql and finally the id.
+	"""
+	featured, key, pk = cursor
+	# featured is compared with a boolean column
+	featured = bool(featured)
+	if descending:
+		op = '<'
+	else:
+		op = '>'
+	where = '(%(f)s < %%s OR (%(f)s = %%s AND (%(k)s %(op)s %%s OR (%(k)s = %%s AND adposting_ad.id %(op)s %%s))))' % {'f': featured_sql, 'k': sort_sql, 'op': op}
+	params = featured_params + [featured] + featured_params + [featured] + sort_params + [key] + sort_params + [key, pk]
+	return qs.extra(where=[where], params=params)
+
+class KeysetPage(object):
+	"""
+	Stands in for django.core.paginator.Page in keyset mode.
+	"""
+	number = 1
+
+	def __init__(self, object_list, cursor, next_cursor):
+		self.object_list = object_list
+		self.cursor = cursor
+		self.next_cursor = next_cursor
+
+	def has_next(self):
+		return self.next_cursor is not None
+
+	def has_previous(self):
+		return bool(self.cursor)
+
+	def has_other_pages(self):
+		return self.has_next() or self.has_previous()
+
+def keyset_page(qs, perpage, cursor, featured_sql, featured_params, sort_sql, sort_params, key_attr, descending):
+	"""
+	Returns the KeysetPage of qs that follows cursor (the first page if
+	cursor is empty).  qs must select 'featured' and be ordered as
+	described in after_cursor; key_attr is the attribute of the ads that
+	holds the sort key.
+	"""
+	position = decode_cursor(cursor)
+	if position is not None:
+		qs = after_cursor(qs, position, featured_sql, featured_params, sort_sql, sort_params, descending)
+
+	# fetch one extra row to find out whether there is a next page
+	ads = list(qs[:perpage + 1])
+	next_cursor = None
+	if len(ads) > perpage:
+		ads = ads[:perpage]
+		last = ads[-1]
+		next_cursor = encode_cursor(last.featured, getattr(last, key_attr), last.pk)
+
+	return KeysetPage(ads, cursor, next_cursor)
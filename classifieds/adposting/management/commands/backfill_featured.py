@@ -0,0 +1,16 @@
+"""
+  $Id$
+
+Sets the featured period of the ads that were paid for as featured
+listings before Ad.featured_until existed, see cron.backfill_featured.
+Run it once after upgrading, so that they keep their placement.
+"""
+from django.core.management.base import NoArgsCommand
+
+from classifieds.adposting.cron import backfill_featured
+
+class Command(NoArgsCommand):
+	help = 'Sets featured_until of the ads paid for as featured listings from their payments.'
+
+	def handle_noargs(self, **options):
+		print '%d featured ads backfilled' % backfill_featured()
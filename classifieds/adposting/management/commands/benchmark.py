@@ -0,0 +1,74 @@
+"""
+  $Id$
+
+Seeds a test database with synthetic data and times the hot paths, see
+classifieds/adposting/benchmark.py.
+"""
+from django.core.cache import get_cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+from classifieds.adposting import benchmark
+
+from optparse import make_option
+
+import os, platform
+
+class Command(BaseCommand):
+	help = 'Times searches, sorts, ad saves and the cron digest on a synthetic data set in a test database.'
+	option_list = BaseCommand.option_list + tuple([
+		make_option('--' + name, type='int', default=default, help='default: %d' % default)
+		for name, default in sorted(benchmark.DEFAULTS.items())
+	]) + (
+		make_option('--only', action='append', default=[], help='only run the named scenario(s)'),
+		make_option('--output', help='write the JSON report to this file'),
+		make_option('--compare', help='compare with an earlier JSON report'),
+	)
+
+	def handle(self, *args, **options):
+		parameters = dict([(name, options[name]) for name in benchmark.DEFAULTS.keys()])
+		only = []
+		for names in options['only']:
+			only += names.split(',')
+		unknown = [name for name in only if name not in [scenario[0] for scenario in benchmark.SCENARIOS]]
+		if unknown:
+			raise CommandError('unknown scenario(s): ' + ', '.join(unknown))
+
+		# never seed the real database, nor fill the site's cache
+		old_name = connection.settings_dict['NAME']
+		connection.creation.create_test_db(verbosity=0, autoclobber=True)
+		old_cache = benchmark.use_cache(get_cache('locmem://'))
+		try:
+			dataset = benchmark.seed(parameters)
+			results = benchmark.run(dataset, parameters['repeat'], only)
+		finally:
+			benchmark.restore_cache(old_cache)
+			connection.creation.destroy_test_db(old_name, verbosity=0)
+
+		report = {
+			'revision': os.popen('git rev-parse --short HEAD 2>/dev/null').read().strip(),
+			'python': platform.python_version(),
+			'database': connection.settings_dict['ENGINE'],
+			'parameters': parameters,
+			'scenarios': results,
+		}
+		if options['output']:
+			f = open(options['output'], 'w')
+			try:
+				simplejson.dump(report, f, indent=2)
+			finally:
+				f.close()
+
+		if options['compare']:
+			f = open(options['compare'])
+			try:
+				old = simplejson.load(f)
+			finally:
+				f.close()
+			for line in benchmark.compare(old, report):
+				print line
+		else:
+			print '%-20s %10s %8s %10s %8s %10s %10s' % ('scenario', 'cold', 'queries', 'warm', 'queries', 'max rss', 'rss growth')
+			for result in results:
+				print '%-20s %8.1fms %8d %8.1fms %8d %8dkB %8dkB' % (result['name'], result['cold']['time'] * 1000, result['cold']['queries'], result['warm']['time'] * 1000, result['warm']['queries'], result['max_rss_kb'], result['rss_growth_kb'])
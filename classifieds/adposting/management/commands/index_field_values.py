@@ -0,0 +1,22 @@
+"""
+  $Id$
+
+Fills in the typed copies (number, sort_key) of the existing field values,
+see models.reindex_field_values.  Run it once after upgrading, so that
+price searches and custom field sorts find the ads posted before the
+values had them.
+"""
+from django.core.management.base import NoArgsCommand
+
+from classifieds.adposting.models import reindex_field_values
+
+from optparse import make_option
+
+class Command(NoArgsCommand):
+	help = 'Refreshes the number and sort_key columns of all field values from their values.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--batch-size', type='int', default=500, help='field values updated per transaction'),
+	)
+
+	def handle_noargs(self, **options):
+		print '%d field values indexed' % reindex_field_values(options['batch_size'])
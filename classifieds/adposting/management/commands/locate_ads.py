@@ -0,0 +1,21 @@
+"""
+  $Id$
+
+Sets the location of the ads that have none from their zip codes, see
+geo.locate_ads.  Run it once after upgrading, so that radius searches find
+the ads posted before ads had a location.
+"""
+from django.core.management.base import NoArgsCommand
+
+from classifieds.adposting.geo import locate_ads
+
+from optparse import make_option
+
+class Command(NoArgsCommand):
+	help = 'Sets the latitude and longitude of the ads that have none from their zip code.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--batch-size', type='int', default=500, help='ads located per transaction'),
+	)
+
+	def handle_noargs(self, **options):
+		print '%d ads located' % locate_ads(options['batch_size'])
@@ -0,0 +1,59 @@
+"""
+  $Id$
+
+Summarizes the query profiles logged by classifieds.profiling by view.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from classifieds.profiling import PROFILER_LOG_FILE
+
+from optparse import make_option
+
+class Command(BaseCommand):
+	help = 'Lists the views that spend the most time in the database, from the sampled query profiles.'
+	args = '[log file]'
+	option_list = BaseCommand.option_list + (
+		make_option('--limit', type='int', default=20, help='number of views to list'),
+		make_option('--sort', default='db_time', choices=('db_time', 'queries', 'n_plus_one'), help='total db_time (default), average queries or n_plus_one'),
+	)
+
+	def handle(self, *args, **options):
+		path = args and args[0] or PROFILER_LOG_FILE
+		if not path:
+			raise CommandError('Give the log file or set PROFILER_LOG_FILE.')
+
+		# view => totals
+		views = {}
+		for line in open(path):
+			start = line.find('{')
+			if start < 0:
+				continue
+			try:
+				profile = simplejson.loads(line[start:])
+			except ValueError:
+				continue
+			view = views.setdefault(profile['name'], {'requests': 0, 'queries': 0, 'max_queries': 0, 'db_time': 0.0, 'n_plus_one': 0, 'patterns': {}})
+			view['requests'] += 1
+			view['queries'] += profile['queries']
+			view['max_queries'] = max(view['max_queries'], profile['queries'])
+			view['db_time'] += profile['db_time']
+			if profile['n_plus_one']:
+				view['n_plus_one'] += 1
+			for pattern in profile['n_plus_one']:
+				view['patterns'][pattern['fingerprint']] = max(view['patterns'].get(pattern['fingerprint'], 0), pattern['count'])
+
+		if options['sort'] == 'queries':
+			sort_key = lambda item: float(item[1]['queries']) / item[1]['requests']
+		else:
+			sort_key = lambda item: item[1][options['sort']]
+		ranked = views.items()
+		ranked.sort(key=sort_key, reverse=True)
+
+		print '%-50s %8s %9s %9s %10s %6s' % ('view', 'requests', 'avg qs', 'max qs', 'db time', 'n+1')
+		for name, view in ranked[:options['limit']]:
+			print '%-50s %8d %9.1f %9d %9.3fs %6d' % (name[-50:], view['requests'], float(view['queries']) / view['requests'], view['max_queries'], view['db_time'], view['n_plus_one'])
+			patterns = [(count, pattern) for pattern, count in view['patterns'].items()]
+			patterns.sort(reverse=True)
+			for count, pattern in patterns[:3]:
+				print '    %4dx %s' % (count, pattern[:120])
@@ -0,0 +1,21 @@
+"""
+  $Id$
+
+Indexes all active ads for keyword searches, see fulltext.rebuild.  Run it
+once after upgrading, as keyword searches only find the ads indexed when
+they were saved, and again after changing SEARCH_BACKEND.
+"""
+from django.core.management.base import NoArgsCommand
+
+from classifieds.adposting.fulltext import rebuild
+
+from optparse import make_option
+
+class Command(NoArgsCommand):
+	help = 'Rebuilds the keyword search index of all active ads.'
+	option_list = NoArgsCommand.option_list + (
+		make_option('--batch-size', type='int', default=500, help='ads indexed per transaction'),
+	)
+
+	def handle_noargs(self, **options):
+		print '%d ads indexed' % rebuild(options['batch_size'])
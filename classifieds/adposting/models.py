@@ -2,7 +2,7 @@
   $Id$
 """
 
-from django.db import models
+from django.db import models, connection, transaction
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
 
@@ -13,9 +13,12 @@ from django.core.mail import send_mail
 
 from django.conf import settings
 
-import datetime
+import datetime, re
 from PIL import Image
 
+from versions import get_version, bump_version
+from geo import get_index
+
 class ImageFormat(models.Model):
   format = models.CharField(max_length=10)
   
@@ -86,6 +89,14 @@ class Field(models.Model):
   def __unicode__(self):
     return self.name + u' field for ' + self.category.name
 
+  def is_numeric(self):
+    """
+    Numeric fields get their value indexed as a number so searches and
+    sorts on them compare numbers instead of text.
+    """
+    return self.field_type in (Field.FLOAT_FIELD, Field.INTEGER_FIELD) or \
+           self.name.endswith('price') or self.name == 'zip_code'
+
 class Ad(models.Model):
   category = models.ForeignKey(Category)
   user = models.ForeignKey(User)
@@ -93,6 +104,16 @@ class Ad(models.Model):
   expires_on = models.DateTimeField()
   active = models.BooleanField() # active means that the ad was actually created
   title = models.CharField(max_length=255)
+  # end of the paid featured listing period, see make_payment
+  featured_until = models.DateTimeField(null=True, blank=True, editable=False)
+  # whether featured_until is still ahead, for the listings to sort on with
+  # an index; set by make_payment and cleared by the 'featured' cron job
+  featured = models.BooleanField(default=False, editable=False)
+  # location of the ad's zip code, see locate() and search.ZipCodeForm
+  latitude = models.FloatField(null=True, blank=True, editable=False)
+  longitude = models.FloatField(null=True, blank=True, editable=False)
+  # set once the owner was told that the ad is about to expire, see cron.py
+  expiry_notice_sent = models.BooleanField(default=False, editable=False)
   
   def __unicode__(self):
     return u'Ad #' + unicode(self.pk) + ' titled "' + self.title + u'" in category ' + self.category.name
@@ -103,35 +124,37 @@ class Ad(models.Model):
     else:
       return False
   
+  def locate(self, zipcode):
+    """
+    Sets latitude and longitude to the location of the given zip code
+    (the first five digits are used), or to None if it is unknown.
+    """
+    self.latitude = self.longitude = None
+    m = re.match(r'^\s*(\d{5})', zipcode or '')
+    if m:
+      location = get_index().location(int(m.group(1)))
+      if location is not None:
+        self.latitude, self.longitude = location
+  
   def fields(self):
-    fields_list = []
-    fields = list(self.category.field_set.all())
-    fields += list(Field.objects.filter(category=None))
-      
-    for field in fields:
-      try:
-        fields_list.append( (field, field.fieldvalue_set.get(ad=self),) )
-      except FieldValue.DoesNotExist:
-        pass
+    # the values are loaded in bulk by load_fields(), which list pages call
+    # for a whole page of ads at once
+    if not hasattr(self, '_fields_cache'):
+      load_fields([self])
         
-    return fields_list
+    return self._fields_cache
   
   def fields_dict(self):
-    fields_dict = {}
-    for key, value in self.fields():
-      fields_dict[key.name] = value.value
+    if not hasattr(self, '_fields_dict_cache'):
+      fields_dict = {}
+      for key, value in self.fields():
+        fields_dict[key.name] = value.value
+      self._fields_dict_cache = fields_dict
       
-    return fields_dict
+    return self._fields_dict_cache
     
   def is_featured(self):
-    for payment in self.payment_set.all():
-      if payment.paid_on <= datetime.datetime.now() and \
-         payment.paid_on + datetime.timedelta(days=payment.pricing.length) >= datetime.datetime.now():
-        for option in payment.options.all():
-          if option.name == PricingOptions.FEATURED_LISTING:
-            return True
-          
-    return False
+    return self.featured_until is not None and self.featured_until >= datetime.datetime.now()
     
   
   def make_payment(self, payment):
@@ -139,6 +162,15 @@ class Ad(models.Model):
     self.expires_on += datetime.timedelta(days=payment.pricing.length)
     self.created_on = datetime.datetime.now()
     self.active = True
+    self.expiry_notice_sent = False
+    # featured listings stay on top for the length of the payment,
+    # counted from the end of any featured period that is still running
+    if payment.options.filter(name=PricingOptions.FEATURED_LISTING).count() > 0:
+      featured_from = self.created_on
+      if self.featured_until is not None and self.featured_until > featured_from:
+        featured_from = self.featured_until
+      self.featured_until = featured_from + datetime.timedelta(days=payment.pricing.length)
+      self.featured = True
     self.save()
     
     # send email for payment
@@ -151,45 +183,273 @@ class Ad(models.Model):
 
 import StringIO
 from os.path import basename
+from django.core.files.base import ContentFile
 
 class AdImage(models.Model):
   ad = models.ForeignKey(Ad)
   full_photo = models.ImageField(upload_to='uploads/', blank=True)
   thumb_photo = models.ImageField(upload_to='uploads/thumbnails/', blank=True)
+  # new uploads are processed in the background, see images.py
+  processed = models.BooleanField(default=False, db_index=True, editable=False)
   
-  def generate_thumbnail(self):
-    image = Image.open(self.full_photo.path)
-    if image.mode != "RGB":
-      image = image.convert('RGB')
-    # resize
-    image = image.resize((128,128))
-    # save as thumb_photo
-    f = StringIO.StringIO()
-    image.save(f, "JPEG")
-    
-    self.save_thumb_photo_file(basename(self.full_photo.path), f.getvalue())
-  
-  def resize(self):
+  def process(self):
+    """
+    Shrinks the full photo to the category's maximum size and generates
+    the renditions, decoding the uploaded image only once.
+    """
     max_width = self.ad.category.images_max_width
     max_height = self.ad.category.images_max_height
     image = Image.open(self.full_photo.path)
+    # draft() changes the size, whether the upload needs shrinking depends
+    # on the original one
+    original_width, original_height = image.size
+    # let the JPEG decoder downscale while decoding, to no less than
+    # anything we need from it
+    draft_width, draft_height = max_width, max_height
+    for name, (width, height) in IMAGE_RENDITIONS:
+      draft_width = max(draft_width, width)
+      draft_height = max(draft_height, height)
+    image.draft('RGB', (draft_width, draft_height))
     if image.mode != "RGB":
       image = image.convert('RGB')
     
-    height, width = image.size
-    if height > max_height or width > max_width:
+    if original_width > max_width or original_height > max_height:
       image.thumbnail( (max_width, max_height), Image.ANTIALIAS )
       image.save(self.full_photo.path)
     
+    old_renditions = list(self.adimagerendition_set.all())
+    self.adimagerendition_set.all().delete()
+    
+    # largest first, so that each rendition can be made from the last one
+    sizes = list(IMAGE_RENDITIONS)
+    sizes.sort(key=lambda rendition: rendition[1][0] * rendition[1][1], reverse=True)
+    new_names = []
+    for name, size in sizes:
+      image = image.copy()
+      image.thumbnail(size, Image.ANTIALIAS)
+      rendition = AdImageRendition.create(self, name, image)
+      new_names.append(rendition.photo.name)
+      if name == 'thumb':
+        self.thumb_photo.name = rendition.photo.name
+    
+    # remove the files of the previous renditions unless they are still used
+    for rendition in old_renditions:
+      if rendition.photo.name not in new_names and \
+         AdImageRendition.objects.filter(photo=rendition.photo.name).count() == 0:
+        rendition.photo.storage.delete(rendition.photo.name)
+    
+    self.processed = True
+    self.save()
+  
+  def renditions_dict(self):
+    """
+    The renditions of this image by name, e.g. for templates:
+    {{ image.renditions_dict.detail.photo.url }}
+    """
+    if not hasattr(self, '_renditions_dict_cache'):
+      renditions = {}
+      for rendition in self.adimagerendition_set.all():
+        renditions[rendition.name] = rendition
+      self._renditions_dict_cache = renditions
+    
+    return self._renditions_dict_cache
+
+import hashlib
+
+# the sizes AdImage.process() makes of every image (name, (max width, max height));
+# the aspect ratio is kept, and 'thumb' is also stored as AdImage.thumb_photo
+IMAGE_RENDITIONS = getattr(settings, 'IMAGE_RENDITIONS', (
+  ('thumb', (128, 128)),
+  ('mobile', (320, 320)),
+  ('detail', (640, 480)),
+))
+
+class AdImageRendition(models.Model):
+  """
+  A downscaled copy of an AdImage.  The files are named after a hash of
+  their contents, so the front end can cache them forever.
+  """
+  image = models.ForeignKey(AdImage)
+  name = models.CharField(max_length=20)
+  photo = models.ImageField(upload_to='uploads/renditions/')
+  width = models.IntegerField()
+  height = models.IntegerField()
+  
+  class Meta:
+    unique_together = (('image', 'name'),)
+  
+  @classmethod
+  def create(cls, adimage, name, image):
+    f = StringIO.StringIO()
+    image.save(f, "JPEG")
+    data = f.getvalue()
+    digest = hashlib.sha1(data).hexdigest()
+    path = 'uploads/renditions/%s/%s.jpg' % (digest[:2], digest)
+    
+    rendition = cls(image=adimage, name=name, width=image.size[0], height=image.size[1])
+    storage = rendition.photo.storage
+    # the same contents always get the same name, so an existing file is reused
+    if not storage.exists(path):
+      path = storage.save(path, ContentFile(data))
+    rendition.photo.name = path
+    rendition.save()
+    
+    return rendition
 
 class FieldValue(models.Model):
   field = models.ForeignKey(Field)
   ad = models.ForeignKey(Ad)
   value = models.TextField()
+  # typed copies of value for searching and sorting, see sql/fieldvalue.sql
+  number = models.FloatField(null=True, blank=True, editable=False)
+  sort_key = models.CharField(max_length=64, blank=True, editable=False)
 
   def __unicode__(self):
     return self.value
   
+  def update_index(self):
+    """
+    Refreshes the typed columns from self.value.
+    """
+    # text values sort case insensitively on their first 64 characters
+    self.sort_key = self.value.strip().lower()[:64]
+    self.number = None
+    if self.field.is_numeric():
+      if self.field.name == 'zip_code':
+        # only the first five digits of a ZIP+4 code are searchable
+        m = re.match(r'^\s*(\d{5})', self.value)
+      else:
+        m = re.match(r'^\s*\$?(-?[\d,]*\.?\d+)\s*$', self.value)
+      if m:
+        self.number = float(m.group(1).replace(',', ''))
+  
+  def save(self, *args, **kwargs):
+    self.update_index()
+    super(FieldValue, self).save(*args, **kwargs)
+
+def save_field_values(created, updated):
+  """
+  Inserts the created and updates the updated FieldValue objects with one
+  executemany each.  This bypasses FieldValue.save(), so update_index()
+  must have been called on them; the caller handles the transaction.
+  """
+  cursor = connection.cursor()
+  qn = connection.ops.quote_name
+  table = qn(FieldValue._meta.db_table)
+  if created:
+    cursor.executemany('INSERT INTO %s (%s, %s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s, %%s)' % (table, qn('field_id'), qn('ad_id'), qn('value'), qn('number'), qn('sort_key')),
+                       [(fv.field_id, fv.ad_id, fv.value, fv.number, fv.sort_key) for fv in created])
+  if updated:
+    cursor.executemany('UPDATE %s SET %s = %%s, %s = %%s, %s = %%s WHERE %s = %%s' % (table, qn('value'), qn('number'), qn('sort_key'), qn('id')),
+                       [(fv.value, fv.number, fv.sort_key, fv.pk) for fv in updated])
+  transaction.set_dirty()
+
+def reindex_field_values(batch_size=500):
+  """
+  Refreshes the typed columns (number and sort_key) of all field values,
+  batch_size at a time, e.g. for the values saved before they existed,
+  which searches and sorts on them would otherwise miss.  Returns the
+  number of values updated.
+  """
+  updated = 0
+  last_pk = 0
+  while True:
+    fvs = list(FieldValue.objects.filter(pk__gt=last_pk).select_related('field', 'ad').order_by('pk')[:batch_size])
+    if not fvs:
+      break
+    for fv in fvs:
+      fv.update_index()
+    save_field_values([], fvs)
+    transaction.commit_unless_managed()
+    # the values are written without signals; drop the cached searches
+    for category_id in set([fv.ad.category_id for fv in fvs]):
+      bump_version('category:%d' % category_id)
+    updated += len(fvs)
+    last_pk = fvs[-1].pk
+  return updated
+
+# category id => list of Field objects, for the schema version in 'version'
+_schema_cache = {'version': None}
+
+def field_schema(category_ids):
+  """
+  Returns a dict mapping each of the given category ids to the list of
+  Field objects for ads in that category (the category's own fields
+  followed by the global fields).  The lists are cached in the process
+  until the 'schema' version is bumped (see signals.py), so they must not
+  be modified.
+  """
+  version = get_version('schema')
+  if _schema_cache['version'] != version:
+    _schema_cache.clear()
+    _schema_cache['version'] = version
+  
+  missing = [category_id for category_id in set(category_ids) if category_id not in _schema_cache]
+  if missing:
+    schema = {}
+    global_fields = []
+    for category_id in missing:
+      schema[category_id] = []
+    
+    for field in Field.objects.filter(models.Q(category__in=missing) | models.Q(category=None)):
+      if field.category_id is None:
+        global_fields.append(field)
+      else:
+        schema[field.category_id].append(field)
+    
+    for category_id in missing:
+      _schema_cache[category_id] = schema[category_id] + global_fields
+  
+  schema = {}
+  for category_id in category_ids:
+    schema[category_id] = _schema_cache[category_id]
+  
+  return schema
+
+def load_fields(ads):
+  """
+  Fetches the field values of all the given ads with one query and
+  attaches them to the ads, so that Ad.fields() and Ad.fields_dict()
+  don't have to go back to the database.  Returns the ads as a list.
+  """
+  ads = list(ads)
+  if not ads:
+    return ads
+  
+  schema = field_schema([ad.category_id for ad in ads])
+  
+  values = {}
+  for fv in FieldValue.objects.filter(ad__in=[ad.pk for ad in ads]):
+    values[(fv.ad_id, fv.field_id)] = fv
+  
+  for ad in ads:
+    fields_list = []
+    for field in schema[ad.category_id]:
+      fv = values.get((ad.pk, field.pk))
+      if fv is not None:
+        fv.field = field
+        fv.ad = ad
+        fields_list.append( (field, fv,) )
+    
+    ad._fields_cache = fields_list
+    if hasattr(ad, '_fields_dict_cache'):
+      del ad._fields_dict_cache
+  
+  return ads
+  
+class SearchTerm(models.Model):
+  """
+  An entry of the built-in full text index: a term of an ad, with its
+  (field weighted) term frequency and the BM25 tf score, see fulltext.py.
+  """
+  ad = models.ForeignKey(Ad)
+  term = models.CharField(max_length=64)
+  tf = models.FloatField()
+  score = models.FloatField()
+
+  def __unicode__(self):
+    return self.term
+  
 class Pricing(models.Model):
   length = models.IntegerField()
   price = models.DecimalField(max_digits=9,decimal_places=2)
@@ -246,15 +506,11 @@ class ZipCode(models.Model):
 #END $$  
 
   def getNearbyZipCodes(self, radius):
-    radius = float(radius)
-    rangeFactor = 0.014457
-    # bounding box
-    objs = ZipCode.objects.filter(latitude__gte=self.latitude-(radius*rangeFactor), latitude__lte=self.latitude+(radius*rangeFactor), longitude__gte=self.longitude-(radius*rangeFactor),longitude__lte=self.longitude+(radius*rangeFactor))
-    # if there are any results left, use GetDistance stored function to finish
-    if objs.count() > 0:
-      objs = objs.extra(where=['GetDistance(%s,%s,latitude,longitude) <= %s'], params=[self.latitude, self.longitude, radius])
-    
-    return objs
+    """
+    Returns the zip codes within radius miles of this one, closest first.
+    The distances are computed in memory, see geo.py.
+    """
+    return [zipcode for distance, zipcode in get_index().nearby(self.latitude, self.longitude, float(radius))]
 
   def __unicode__(self):
     return u'Zip: ' + unicode(self.zipcode) + u', City: ' + self.city + u', State: ' + self.state
@@ -268,6 +524,23 @@ class SiteSetting(models.Model):
   def __unicode__(self):
     return self.description
 
+class JobCheckpoint(models.Model):
+  """
+  How far a batched job got, so that a run that was killed resumes where
+  it stopped; position is usually the last primary key done.
+  """
+  name = models.CharField(max_length=100, unique=True)
+  position = models.IntegerField(default=0)
+  updated_on = models.DateTimeField(auto_now=True)
+  
+  def __unicode__(self):
+    return self.name + u' at ' + unicode(self.position)
+  
+  @classmethod
+  def get(cls, name):
+    checkpoint, created = cls.objects.get_or_create(name=name)
+    return checkpoint
+
 from paypal.standard.ipn.models import PayPalIPN
 
 class Payment(models.Model):
@@ -308,3 +581,5 @@ class UserProfile(models.Model):
   zipcode = models.CharField(max_length=10, blank=True)
   phone = PhoneNumberField(blank=True, default='')
 
+# connect the paypal signal handlers
+import signals
@@ -0,0 +1,81 @@
+"""
+  $Id$
+
+Site configuration.
+
+The SiteSetting rows of the current site are loaded once per process and
+kept until one of them changes, which bumps the 'sitesettings' version (see
+signals.py and versions.py), so reading a setting costs no query.  The
+values are stored as text; get_int, get_bool and get_list convert them.
+"""
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+
+from models import SiteSetting
+from versions import get_version, prune
+
+# (site id, version) => {name: value}
+_site_settings = {}
+# (site id, version) => Site
+_sites = {}
+
+def current_site():
+	"""
+	Site.objects.get_current(), kept until a Site changes.
+	"""
+	key = (settings.SITE_ID, get_version('site'))
+	if key not in _sites:
+		prune(_sites, key[1])
+		_sites[key] = Site.objects.get(pk=settings.SITE_ID)
+	return _sites[key]
+
+def site_settings(site_id=None):
+	"""
+	Returns a dict of all settings of the site (the current one by default).
+	"""
+	if site_id is None:
+		site_id = settings.SITE_ID
+	key = (site_id, get_version('sitesettings'))
+	if key not in _site_settings:
+		prune(_site_settings, key[1])
+		_site_settings[key] = dict(SiteSetting.objects.filter(site=site_id).values_list('name', 'value'))
+	return _site_settings[key]
+
+def get(name, default=None):
+	return site_settings().get(name, default)
+
+def get_int(name, default=0):
+	try:
+		return int(get(name, default))
+	except (TypeError, ValueError):
+		return default
+
+def get_bool(name, default=False):
+	value = get(name)
+	if value is None:
+		return default
+	return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def get_list(name, default=()):
+	"""
+	A comma separated setting as a list of its stripped, non-empty items.
+	"""
+	value = get(name)
+	if value is None:
+		return list(default)
+	return [item.strip() for item in value.split(',') if item.strip()]
+
+# the settings the cron jobs use
+
+def from_email():
+	return get('from_email', settings.FROM_EMAIL)
+
+def notice_posting_new():
+	# days of new postings in the digest
+	return get_int('notice_posting_new', 1)
+
+def notice_posting_expires():
+	# days before an ad expires that its owner is told, and after it
+	# expired that it is deleted
+	return get_int('notice_posting_expires', 1)
@@ -0,0 +1,46 @@
+"""
+  $Id$
+
+LEFT OUTER JOINs with conditions of their own, which the ORM can't express
+(its joins only compare two columns, and filter() turns them into inner
+joins), e.g. to sort ads on the value of one of their fields while keeping
+the ads that have none, see views.sort_spec.
+
+	ads = outer_join(ads, 'adposting_fieldvalue sortvalue ON (sortvalue.ad_id = adposting_ad.id AND sortvalue.field_id = %s)', [field_id])
+"""
+
+from django.db.models.sql.query import Query
+
+class OuterJoinQuery(Query):
+	"""
+	A Query with LEFT OUTER JOINs, (sql, params), after its first table.
+	"""
+	def clone(self, *args, **kwargs):
+		obj = super(OuterJoinQuery, self).clone(*args, **kwargs)
+		obj.outer_joins = self.outer_joins[:]
+		return obj
+
+	def get_compiler(self, using=None, connection=None):
+		compiler = super(OuterJoinQuery, self).get_compiler(using, connection)
+		get_from_clause = compiler.get_from_clause
+		def from_clause():
+			result, params = get_from_clause()
+			params = list(params)
+			joins = []
+			for sql, join_params in self.outer_joins:
+				joins.append('LEFT OUTER JOIN ' + sql)
+				params += join_params
+			return result[:1] + joins + result[1:], params
+		compiler.get_from_clause = from_clause
+		return compiler
+
+def outer_join(qs, sql, params):
+	"""
+	Returns qs with 'LEFT OUTER JOIN ' + sql after its first table.
+	"""
+	qs = qs._clone()
+	if not isinstance(qs.query, OuterJoinQuery):
+		qs.query = qs.query.clone(klass=OuterJoinQuery)
+		qs.query.outer_joins = []
+	qs.query.outer_joins.append((sql, params))
+	return qs
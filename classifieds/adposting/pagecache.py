@@ -0,0 +1,107 @@
+"""
+  $Id$
+
+Page caching for anonymous visitors.
+
+The public pages are the same for every visitor who isn't logged in, so
+they are rendered once and kept in the Django cache under the versions of
+what they show (see versions.py): 'ad:<id>' is bumped when the ad is saved,
+paid for, deleted or its images are processed, 'category:<id>' when any ad
+in the category is, and 'schema' when the categories change.  A change
+therefore invalidates exactly the pages that show it.
+
+Each page gets an ETag and a Last-Modified date from the versions and the
+time it was rendered, so that browsers and crawlers that already have the
+page get a 304.  Not everything that changes a page bumps a version (ads
+expire, for one), so pages are rendered anew at least every
+PAGE_CACHE_TIMEOUT seconds, which also changes the validators.  The site ads
+are left out of the cached pages and picked anew every time a page is
+served, see siteads/templatetags/siteads.py.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.functional import wraps
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date
+
+from classifieds.siteads.templatetags.siteads import fill_slots
+from versions import get_version
+
+from email.Utils import parsedate_tz, mktime_tz
+import time
+
+# seconds a page is cached at most
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60 * 10)
+
+def not_modified(request, etag, last_modified):
+	"""
+	Whether the client's copy of the page is still current.
+	"""
+	if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+	if if_none_match:
+		tags = [tag.strip() for tag in if_none_match.split(',')]
+		return '"%s"' % etag in tags or '*' in tags
+
+	if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+	if if_modified_since:
+		since = parsedate_tz(if_modified_since.split(';')[0])
+		if since is not None:
+			return int(last_modified) <= mktime_tz(since)
+	return False
+
+def cache_anonymous(page_key):
+	"""
+	Caches a view for anonymous visitors.  page_key(request, *args,
+	**kwargs) returns the version keys the page depends on and a value
+	for anything else it varies on (besides the url), or None if the
+	request shouldn't be cached.  A view can set cache_until (a datetime)
+	on its response for pages that must not be served past a certain time,
+	like an ad's expiry.
+	"""
+	def decorator(view):
+		@wraps(view)
+		def wrapped(request, *args, **kwargs):
+			if request.method not in ('GET', 'HEAD') or request.user.is_authenticated():
+				return view(request, *args, **kwargs)
+			key = page_key(request, *args, **kwargs)
+			if key is None:
+				return view(request, *args, **kwargs)
+
+			version_keys, variant = key
+			versions = [get_version(version_key) for version_key in version_keys]
+			cache_key = 'page:' + md5_constructor(repr((request.get_full_path(), variant, version_keys, versions))).hexdigest()
+
+			cached = cache.get(cache_key)
+			if cached is None or (cached[2] is not None and cached[2] <= time.time()):
+				request.defer_siteads = True
+				response = view(request, *args, **kwargs)
+				if response.status_code != 200:
+					return response
+
+				until = getattr(response, 'cache_until', None)
+				timeout = PAGE_CACHE_TIMEOUT
+				if until is not None:
+					until = time.mktime(until.timetuple())
+					timeout = int(min(timeout, until - time.time()))
+				cached = (response.content, response['Content-Type'], until, int(time.time()))
+				if timeout > 0:
+					cache.set(cache_key, cached, timeout)
+
+			last_modified = cached[3]
+			etag = '%s-%d' % (cache_key[5:], last_modified)
+			if not_modified(request, etag, last_modified):
+				response = HttpResponseNotModified()
+			else:
+				response = HttpResponse(fill_slots(cached[0]), content_type=cached[1])
+			response['ETag'] = '"%s"' % etag
+			response['Last-Modified'] = http_date(last_modified)
+			# browsers have to check back, the page changes with the ads
+			patch_cache_control(response, max_age=0)
+			patch_vary_headers(response, ('Cookie',))
+			return response
+
+		return wrapped
+	return decorator
@@ -4,8 +4,11 @@
 
 from django import forms
 from django.contrib.localflavor.us import forms as us_forms
+from django.db.models import Q
 
 from models import *
+from geo import get_index, distance_sql, longitude_span, MILES_PER_DEGREE
+from fulltext import get_backend
 
 class PriceRangeForm(forms.Form):
 	"""
@@ -22,9 +25,8 @@ class PriceRangeForm(forms.Form):
 	Remember to validate this form (call is_valid()) before calling this function.
 	"""
 		if not self.is_empty():
-			fvs = FieldValue.objects.filter(field__name="price",value__range=(float(self.data["lowest"]),float(self.data["highest"])))
-			validAds = [fv.ad.pk for fv in fvs]
-			return qs.filter(pk__in=validAds)
+			fvs = FieldValue.objects.filter(field__name="price",number__range=(float(self.data["lowest"]),float(self.data["highest"])))
+			return qs.filter(pk__in=fvs.values('ad').query)
 		else:
 			return qs
 	   
@@ -52,17 +54,25 @@ class ZipCodeForm(forms.Form):
 	
 	def filter(self,qs):
 		"""
-	Returns a new QuerySet with only items in the given zip code.
-	Remember to validate this form before calling this function.
+	Returns a new QuerySet with only items within the given range of
+	the zip code.  Remember to validate this form before calling this
+	function.
 	"""
 		if not self.is_empty():
-			zipcodeObj = ZipCode.objects.get(zipcode=self.cleaned_data["zip_code"])
-			zipcodes = [zipcode.zipcode for zipcode in zipcodeObj.getNearbyZipCodes(self.cleaned_data["zip_range"])]
+			location = get_index().location(int(self.cleaned_data["zip_code"][:5]))
+			if location is None:
+				return qs.none()
+			latitude, longitude = location
+			radius = float(self.cleaned_data["zip_range"])
 			
-			fvs = FieldValue.objects.filter(field__name="zip_code").filter(value__in=list(zipcodes))
-			
-			validAds = [fv.ad.pk for fv in fvs]
-			return qs.filter(pk__in=validAds)
+			# the bounding box can use the index on the ads' location,
+			# the distance check then trims its corners
+			lat_span = radius / MILES_PER_DEGREE
+			lon_span = longitude_span(latitude, radius)
+			distance = distance_sql(latitude, longitude)
+			# the results can be sorted by distance, see views.context_sortable
+			self.extra_sorts = {'distance': (distance, [])}
+			return qs.filter(latitude__range=(latitude - lat_span, latitude + lat_span), longitude__range=(longitude - lon_span, longitude + lon_span)).extra(where=[distance + ' <= %s'], params=[lat_span * lat_span])
 		else:
 			return qs
 		
@@ -105,19 +115,13 @@ class MultiForm(forms.Form):
 	one attribute that matches the user's keywords.
 	"""
 		if not self.is_empty():
-			# Create a set of all field value IDs
-			allAdIDs = set()
-
-			if 'title' in self.fieldNames:
-				ad_title_qs = Ad.objects.filter(title__search=self.cleaned_data["keywords"])
-				allAdIDs |= set([val.pk for val in ad_title_qs])
-			
-			fvs = set(FieldValue.objects.filter(value__search=self.cleaned_data["keywords"]))
+			backend = get_backend()
+			relevance = backend.relevance(self.cleaned_data["keywords"])
+			if relevance is not None:
+				# the results can be sorted by relevance, see views.context_sortable
+				self.extra_sorts = {'relevance': relevance}
 				
-			# Join the current set with this set
-			allAdIDs |= set([val.ad.pk for val in fvs])
-				
-			return qs.filter(pk__in=list(allAdIDs))
+			return backend.filter(qs, self.cleaned_data["keywords"])
 		else:
 			return qs
 	
@@ -155,19 +159,22 @@ class SelectForm(forms.Form):
 	def filter(self, qs):
 		# filter search results
 		if not self.is_empty():
-			allAdIDs = set()
+			matches = None
 
 			for field in self.fields.keys():
 				if self.data.has_key(field) and self.data[field] != "" and self.data[field] != [] and self.data[field] != ['']:
 					if type(self.data[field]) == type([]):
-						fvs = set(FieldValue.objects.filter(field__name=field,value__in=self.data[field]))
+						fvs = FieldValue.objects.filter(field__name=field,value__in=self.data[field])
 					else:
-						fvs = set(FieldValue.objects.filter(field__name=field,value=self.data[field]))
+						fvs = FieldValue.objects.filter(field__name=field,value=self.data[field])
 					
-					# Join the current set with this set
-					allAdIDs |= set([val.ad.pk for val in fvs])
+					# an ad matches if any of the selected fields match
+					if matches is None:
+						matches = Q(pk__in=fvs.values('ad').query)
+					else:
+						matches |= Q(pk__in=fvs.values('ad').query)
 			
-			return qs.filter(pk__in=list(allAdIDs))
+			return qs.filter(matches)
 
 		return qs
 
@@ -0,0 +1,130 @@
+"""
+  $Id$
+
+Cache of search results.
+
+search_results caches the ordered list of ad ids for every normalized
+search (category, filters, sort and order) in the process, with the sorts
+offered and the sort key it was ordered by, so that paging through the
+results or coming back to them doesn't run the filters again.  Searches
+with more than SEARCH_CACHE_MAX_RESULTS results keep their count instead
+of the ids, and only query the page shown.
+The keys include the category's version, which is bumped whenever an ad in
+the category is saved, paid for or deleted (see signals.py); results that
+only went stale because an ad expired in the meantime live at most
+SEARCH_CACHE_TIMEOUT seconds.
+
+It also keeps the facet counts shown next to the options of the select
+fields on the search page.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from models import FieldValue
+from versions import get_version
+
+import datetime, threading, time
+
+# number of searches kept
+SEARCH_CACHE_SIZE = getattr(settings, 'SEARCH_CACHE_SIZE', 500)
+# seconds a search is kept
+SEARCH_CACHE_TIMEOUT = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300)
+# searches with more results than this only have their count cached
+SEARCH_CACHE_MAX_RESULTS = getattr(settings, 'SEARCH_CACHE_MAX_RESULTS', 1000)
+
+class LRUCache(object):
+	"""
+	A size bounded cache whose entries also expire after timeout seconds;
+	when it is full the least recently used entry is dropped.
+	"""
+	def __init__(self, max_size, timeout):
+		self.max_size = max_size
+		self.timeout = timeout
+		# key => [expires, last use, value]
+		self.entries = {}
+		self.ticks = 0
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		self.lock.acquire()
+		try:
+			entry = self.entries.get(key)
+			if entry is None:
+				return None
+			if entry[0] < time.time():
+				del self.entries[key]
+				return None
+			self.ticks += 1
+			entry[1] = self.ticks
+			return entry[2]
+		finally:
+			self.lock.release()
+
+	def set(self, key, value):
+		self.lock.acquire()
+		try:
+			if key not in self.entries and len(self.entries) >= self.max_size:
+				self.evict()
+			self.ticks += 1
+			self.entries[key] = [time.time() + self.timeout, self.ticks, value]
+		finally:
+			self.lock.release()
+
+	def evict(self):
+		# drop the expired entries, or the least recently used one if none is
+		now = time.time()
+		expired = [key for key, entry in self.entries.items() if entry[0] < now]
+		if not expired:
+			expired = [min(self.entries.items(), key=lambda item: item[1][1])[0]]
+		for key in expired:
+			del self.entries[key]
+
+	def clear(self):
+		self.lock.acquire()
+		try:
+			self.entries.clear()
+		finally:
+			self.lock.release()
+
+search_cache = LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TIMEOUT)
+
+def normalize_search(data):
+	"""
+	Turns the submitted search form (a dict of field name => list of
+	values, as stored in the session) into a hashable key that doesn't
+	depend on the order of the fields and values or on empty fields.
+	"""
+	items = []
+	for name, values in data.items():
+		if name == 'csrfmiddlewaretoken':
+			continue
+		if not isinstance(values, (list, tuple)):
+			values = [values]
+		values = [value for value in values if value != '']
+		if values:
+			values.sort()
+			items.append((name, tuple(values)))
+	items.sort()
+	return tuple(items)
+
+def facet_counts(category_id, field_ids):
+	"""
+	Returns a dict mapping (field id, value) to the number of active ads in
+	the category with that value, for the given (select) fields.  All
+	fields are counted in one grouped query, which is cached until an ad in
+	the category or the fields change, or for SEARCH_CACHE_TIMEOUT seconds,
+	as ads also drop out when they expire.
+	"""
+	if not field_ids:
+		return {}
+	key = 'facets:%d:%d:%d' % (category_id, get_version('category:%d' % category_id), get_version('schema'))
+	counts = cache.get(key)
+	if counts is None:
+		counts = {}
+		rows = FieldValue.objects.filter(field__in=field_ids, ad__category=category_id, ad__active=True, ad__expires_on__gt=datetime.datetime.now()).values('field', 'value').annotate(count=Count('ad')).order_by()
+		for row in rows:
+			counts[(row['field'], row['value'])] = row['count']
+		cache.set(key, counts, SEARCH_CACHE_TIMEOUT)
+	return counts
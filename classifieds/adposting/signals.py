@@ -4,14 +4,81 @@
 
 """
 
+from django.db.models.signals import post_save, post_delete
 from paypal.standard.signals import payment_was_successful
-from models import Payment
+from django.contrib.sites.models import Site
+from models import Ad, AdImage, Payment, Pricing, PricingOptions, Category, Field, SiteSetting, ZipCode
+from fulltext import get_backend
+from versions import bump_version
+import geo
         
 def make_payment(sender, **kwargs):
   payment = Payment.objects.get(pk=sender.item_number)
-	payment.paid = True
-	payment.paid_on = datetime.datetime.now()
-	payment.save()
-	payment.ad.make_payment(payment)
+  # paid and paid_on are read from the ipn
+  payment.paypal = sender
+  payment.save()
+  payment.ad.make_payment(payment)
 
-payment_was_successful.connect(make_payment)
+# the package is imported both as classifieds.adposting and as
+# iportal.classifieds.adposting, so every handler has a dispatch_uid to be
+# connected only once
+payment_was_successful.connect(make_payment, dispatch_uid='adposting.make_payment')
+
+def schema_changed(sender, **kwargs):
+  # drops the cached field lists and compiled forms, see models.field_schema
+  bump_version('schema')
+
+for model in (Category, Field):
+  post_save.connect(schema_changed, sender=model, dispatch_uid='adposting.schema_changed.%s' % model.__name__)
+  post_delete.connect(schema_changed, sender=model, dispatch_uid='adposting.schema_changed.%s' % model.__name__)
+
+post_save.connect(geo.reset_index, sender=ZipCode, dispatch_uid='adposting.geo.reset_index')
+post_delete.connect(geo.reset_index, sender=ZipCode, dispatch_uid='adposting.geo.reset_index')
+
+def site_changed(sender, **kwargs):
+  # see options.py
+  bump_version('site')
+
+def site_settings_changed(sender, **kwargs):
+  bump_version('sitesettings')
+
+post_save.connect(site_changed, sender=Site, dispatch_uid='adposting.site_changed')
+post_delete.connect(site_changed, sender=Site, dispatch_uid='adposting.site_changed')
+post_save.connect(site_settings_changed, sender=SiteSetting, dispatch_uid='adposting.site_settings_changed')
+post_delete.connect(site_settings_changed, sender=SiteSetting, dispatch_uid='adposting.site_settings_changed')
+
+def pricing_changed(sender, **kwargs):
+  bump_version('pricing')
+
+for model in (Pricing, PricingOptions):
+  post_save.connect(pricing_changed, sender=model, dispatch_uid='adposting.pricing_changed.%s' % model.__name__)
+  post_delete.connect(pricing_changed, sender=model, dispatch_uid='adposting.pricing_changed.%s' % model.__name__)
+
+def ad_changed(sender, instance, **kwargs):
+  # drops the cached searches of the ad's category (see searchcache.py) and
+  # the cached pages showing the ad (see pagecache.py); this covers edits,
+  # payments and the deletion of expired ads.  Drafts (see
+  # views.create_in_category) aren't shown anywhere until they are paid for.
+  if not instance.active:
+    return
+  bump_version('category:%d' % instance.category_id)
+  bump_version('ad:%d' % instance.pk)
+  # and the sitemap, see sitemaps.py
+  bump_version('ads')
+
+def ad_image_changed(sender, instance, **kwargs):
+  # e.g. when the renditions are done, see AdImage.process; the listings
+  # show the thumbnails
+  if not instance.ad.active:
+    return
+  bump_version('category:%d' % instance.ad.category_id)
+  bump_version('ad:%d' % instance.ad_id)
+
+def ad_deleted(sender, instance, **kwargs):
+  get_backend().remove(instance.pk)
+
+post_save.connect(ad_changed, sender=Ad, dispatch_uid='adposting.ad_changed')
+post_delete.connect(ad_changed, sender=Ad, dispatch_uid='adposting.ad_changed')
+post_delete.connect(ad_deleted, sender=Ad, dispatch_uid='adposting.ad_deleted')
+post_save.connect(ad_image_changed, sender=AdImage, dispatch_uid='adposting.ad_image_changed')
+post_delete.connect(ad_image_changed, sender=AdImage, dispatch_uid='adposting.ad_image_changed')
@@ -1,13 +1,29 @@
 """
   $Id$
+
+sitemap.xml is an index of sections that each cover SITEMAP_SECTION_SIZE
+ad ids, so no section exceeds the 50,000 urls a sitemap may have.  The
+sections are streamed from an iterator over the ids and dates of the ads
+instead of being built in memory.  Both carry the time of the last change
+to any ad (for the sections, or the last time an ad expired) as
+Last-Modified and answer If-Modified-Since with a 304; the index is also
+cached until the next change.
 """
 from django.contrib.sitemaps import Sitemap
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db.models import Max
+from django.http import HttpResponse
+from django.views.decorators.http import condition
 
 from classifieds.adposting.models import Ad
+from options import current_site
+from versions import get_version
 
 import datetime
 
+SITEMAP_SECTION_SIZE = 50000
+
 class AdSitemap(Sitemap):
 	changefreq = 'monthly'
 
@@ -22,3 +38,42 @@ class AdSitemap(Sitemap):
 	
 sitemaps = {'ads': AdSitemap}
 
+def ads_modified(request, *args):
+	# the 'ads' version is bumped by every change to an ad, see signals.py
+	return datetime.datetime.fromtimestamp(get_version('ads') / 1000000.0)
+
+def section_modified(request, number):
+	# ads drop out of the sections when they expire, which doesn't change
+	# them; the last expiry so far is a single lookup on the expires_on index
+	modified = ads_modified(request)
+	expired = Ad.objects.filter(active=True, expires_on__lte=datetime.datetime.now()).aggregate(last=Max('expires_on'))['last']
+	if expired is not None and expired > modified:
+		return expired
+	return modified
+
+@condition(last_modified_func=ads_modified)
+def index(request):
+	key = 'sitemap:index:%d' % get_version('ads')
+	content = cache.get(key)
+	if content is None:
+		domain = current_site().domain
+		last_pk = Ad.objects.aggregate(last_pk=Max('pk'))['last_pk'] or 0
+		parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+		for number in range(last_pk / SITEMAP_SECTION_SIZE + 1):
+			parts.append('<sitemap><loc>http://%s%s</loc></sitemap>\n' % (domain, reverse('classifieds.adposting.sitemaps.section', args=[number])))
+		parts.append('</sitemapindex>\n')
+		content = ''.join(parts)
+		cache.set(key, content)
+	return HttpResponse(content, mimetype='application/xml')
+
+def section_urls(domain, number):
+	yield '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+	ads = Ad.objects.filter(active=True, expires_on__gt=datetime.datetime.now(), pk__gt=number * SITEMAP_SECTION_SIZE, pk__lte=(number + 1) * SITEMAP_SECTION_SIZE)
+	for pk, created_on in ads.order_by('pk').values_list('pk', 'created_on').iterator():
+		yield '<url><loc>http://%s%s</loc><lastmod>%s</lastmod><changefreq>monthly</changefreq></url>\n' % (domain, reverse('classifieds.adposting.views.view', args=[pk]), created_on.strftime('%Y-%m-%d'))
+	yield '</urlset>\n'
+
+@condition(last_modified_func=section_modified)
+def section(request, number):
+	return HttpResponse(section_urls(current_site().domain, int(number)), mimetype='application/xml')
+
@@ -0,0 +1,7 @@
+-- Listing pages filter on category and active and sort featured ads first,
+-- then by expiry date (the default sort); featured is a column rather than a
+-- comparison with featured_until so that the index can give that order.
+CREATE INDEX adposting_ad_listing ON adposting_ad (category_id, active, featured, expires_on);
+CREATE INDEX adposting_ad_expires_on ON adposting_ad (expires_on);
+-- Radius searches filter on a bounding box around the searched zip code.
+CREATE INDEX adposting_ad_location ON adposting_ad (latitude, longitude);
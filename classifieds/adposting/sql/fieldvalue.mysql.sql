@@ -0,0 +1,3 @@
+-- MySQL can only index a prefix of a TEXT column; this covers the
+-- dropdown list (select) field searches.
+CREATE INDEX adposting_fieldvalue_field_value ON adposting_fieldvalue (field_id, value(64), ad_id);
@@ -0,0 +1,6 @@
+-- Composite index for the typed search columns, so that range and IN
+-- searches on numeric fields (price, zip_code, ...) are a single index scan.
+CREATE INDEX adposting_fieldvalue_field_number ON adposting_fieldvalue (field_id, number, ad_id);
+-- Sorting listings on a custom field (see sort_spec) outer joins each ad's
+-- value on this.
+CREATE INDEX adposting_fieldvalue_ad_field ON adposting_fieldvalue (ad_id, field_id);
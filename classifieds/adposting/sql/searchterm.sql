@@ -0,0 +1,2 @@
+-- Keyword searches look up terms by prefix (term LIKE 'abc%'), see fulltext.py.
+CREATE INDEX adposting_searchterm_term ON adposting_searchterm (term, ad_id);
@@ -0,0 +1,400 @@
+"""
+  $Id$
+"""
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sites.models import Site
+from django.http import HttpRequest, HttpResponse, QueryDict
+from django.test import TestCase
+
+from classifieds.profiling import QueryProfile
+from classifieds.adposting.models import Ad, Category, Field, FieldValue, ZipCode
+from classifieds.adposting.fulltext import get_backend
+from classifieds.adposting.versions import get_version
+from classifieds.adposting import pagecache
+
+import datetime, time
+
+class QueryProfileTest(TestCase):
+	def test_counts_queries(self):
+		profile = QueryProfile('test').start()
+		for i in range(3):
+			User.objects.filter(pk=i).count()
+		User.objects.all().count()
+		profile.stop()
+
+		summary = profile.summary()
+		self.assertEqual(summary['queries'], 4)
+		self.assertEqual(len(summary['duplicates']), 0)
+
+	def test_nested_profiles(self):
+		outer = QueryProfile('outer').start()
+		User.objects.count()
+		inner = QueryProfile('inner').start()
+		User.objects.count()
+		inner.stop()
+		outer.stop()
+
+		self.assertEqual(len(inner.queries), 1)
+		self.assertEqual(len(outer.queries), 2)
+		self.assertEqual(outer.summary()['duplicates'][0]['count'], 2)
+
+	def test_n_plus_one(self):
+		profile = QueryProfile('test').start()
+		for i in range(6):
+			User.objects.filter(pk=i).count()
+		profile.stop()
+
+		self.assertEqual(profile.summary()['n_plus_one'][0]['count'], 6)
+
+# what the search form posts when nothing is filled in
+EMPTY_SEARCH = {'lowest': '', 'highest': '', 'zip_code': '', 'zip_range': '', 'keywords': '', 'type': ''}
+
+class AdTestCase(TestCase):
+	"""
+	A category with a few fields, and add_ads() to fill it.
+	"""
+	def setUp(self):
+		self.user = User.objects.create_user('searcher', 'searcher@example.com', 'searcher')
+		self.category = Category.objects.create(site=Site.objects.get_current(), template_prefix='jobs', name='Jobs',
+		                                        contact_form_upload_max_size=0, contact_form_upload_file_extensions='',
+		                                        images_max_count=0, images_max_width=640, images_max_height=480,
+		                                        images_max_size=0, description='', sortby_fields='price')
+		Field.objects.create(name='title', label='Title', field_type=Field.CHAR_FIELD)
+		self.fields = [
+			Field.objects.create(category=self.category, name='price', label='Price', field_type=Field.CHAR_FIELD),
+			Field.objects.create(category=self.category, name='zip_code', label='Zip Code', field_type=Field.CHAR_FIELD),
+			Field.objects.create(category=self.category, name='type', label='Type', field_type=Field.SELECT_FIELD, options='full time,part time'),
+		]
+		ZipCode.objects.create(zipcode=10001, latitude=40.75, longitude=-73.99, city='New York', state='NY')
+		self.ads = 0
+
+		# the views are called directly, without the site's templates;
+		# they are imported here as forms.py queries the pricing on import
+		from classifieds.adposting import views
+		self.views = views
+		self.render_to_response = views.render_to_response
+		views.render_to_response = self.render
+
+	def tearDown(self):
+		self.views.render_to_response = self.render_to_response
+
+	def render(self, template_name, context, **kwargs):
+		# touch what the list template shows of each ad
+		if context.get('page') and context['page'].object_list:
+			for ad in context['page'].object_list:
+				ad.fields_dict()
+				ad.is_featured()
+		return HttpResponse(template_name)
+
+	def add_ads(self, count):
+		for i in range(count):
+			self.ads += 1
+			ad = Ad(category=self.category, user=self.user, active=True, title='guitar teacher %d' % self.ads,
+			        expires_on=datetime.datetime.now() + datetime.timedelta(days=30))
+			ad.locate('10001')
+			ad.save()
+			values = {'price': '%d.00' % (100 + self.ads), 'zip_code': '10001', 'type': 'full time'}
+			for field in self.fields:
+				FieldValue.objects.create(field=field, ad=ad, value=values[field.name])
+			values['title'] = ad.title
+			get_backend().index(ad, values)
+
+	def search(self, filters, query=''):
+		search = {}
+		for name, value in EMPTY_SEARCH.items():
+			search[name] = [filters.get(name, value)]
+		request = HttpRequest()
+		request.method = 'GET'
+		request.GET = QueryDict(query)
+		request.user = self.user
+		request.session = {'search': search}
+		profile = QueryProfile().start()
+		try:
+			self.views.search_results(request, str(self.category.pk))
+		finally:
+			profile.stop()
+		return len(profile.queries)
+
+class SearchQueryCountTest(AdTestCase):
+	"""
+	The number of queries a search takes must not grow with the number of
+	ads it finds.
+	"""
+	def assertConstantQueries(self, filters, query=''):
+		# load the process wide caches (the field schema) first
+		self.search(filters, query)
+		self.add_ads(5)
+		few = self.search(filters, query)
+		self.add_ads(45)
+		many = self.search(filters, query)
+		self.assertEqual(few, many, '%r: %d queries for 5 ads, %d for 50' % (filters, few, many))
+
+	def test_browse(self):
+		self.assertConstantQueries({})
+
+	def test_price(self):
+		self.assertConstantQueries({'lowest': '1', 'highest': '100000'})
+
+	def test_zip_code(self):
+		self.assertConstantQueries({'zip_code': '10001', 'zip_range': '10'})
+
+	def test_keywords(self):
+		self.assertConstantQueries({'keywords': 'guitar'})
+
+	def test_select(self):
+		self.assertConstantQueries({'type': 'full time'})
+
+	def test_sort_by_field(self):
+		self.assertConstantQueries({}, 'sort=price&order=asc')
+
+	def test_cached(self):
+		self.add_ads(5)
+		first = self.search({'keywords': 'guitar'})
+		cached = self.search({'keywords': 'guitar'})
+		self.assertTrue(cached < first, '%d queries before caching, %d after' % (first, cached))
+
+		# too many results to keep the ids: only the page is queried
+		max_results = self.views.SEARCH_CACHE_MAX_RESULTS
+		self.views.SEARCH_CACHE_MAX_RESULTS = 2
+		try:
+			self.search({'keywords': 'teacher'})
+			self.assertEqual(self.search({'keywords': 'teacher'}), cached)
+		finally:
+			self.views.SEARCH_CACHE_MAX_RESULTS = max_results
+
+class FacetTest(AdTestCase):
+	def test_new_fields_are_counted(self):
+		from classifieds.adposting.searchcache import facet_counts
+		self.add_ads(2)
+		self.assertEqual(facet_counts(self.category.pk, [self.fields[2].pk]), {(self.fields[2].pk, 'full time'): 2})
+
+		# a select field added to the category, its values filled in
+		# without touching the ads
+		level = Field.objects.create(category=self.category, name='level', label='Level', field_type=Field.SELECT_FIELD, options='junior,senior')
+		for ad in Ad.objects.all():
+			FieldValue.objects.create(field=level, ad=ad, value='senior')
+		self.assertEqual(facet_counts(self.category.pk, [self.fields[2].pk, level.pk])[(level.pk, 'senior')], 2)
+
+class FeaturedTest(AdTestCase):
+	def test_update_featured(self):
+		from classifieds.adposting.cron import update_featured
+		self.add_ads(3)
+		now = datetime.datetime.now()
+		running, ended, unpaid = Ad.objects.order_by('pk')
+		Ad.objects.filter(pk=running.pk).update(featured_until=now + datetime.timedelta(days=1))
+		Ad.objects.filter(pk=ended.pk).update(featured=True, featured_until=now - datetime.timedelta(days=1))
+
+		self.assertEqual(update_featured(), 2)
+		self.assertEqual(list(Ad.objects.filter(featured=True)), [running])
+		self.assertEqual(update_featured(), 0)
+
+	def test_listed_first(self):
+		self.add_ads(3)
+		featured = Ad.objects.order_by('pk')[1]
+		Ad.objects.filter(pk=featured.pk).update(featured=True)
+		for query in ('', 'cursor='):
+			request = HttpRequest()
+			request.GET = QueryDict(query)
+			context = self.views.context_sortable(request, Ad.objects.all())
+			self.assertEqual(context['page'].object_list[0], featured)
+
+class SortTest(AdTestCase):
+	def test_missing_values_last(self):
+		self.add_ads(3)
+		missing = Ad.objects.order_by('pk')[1]
+		FieldValue.objects.filter(ad=missing, field__name='price').delete()
+		for order in ('asc', 'desc'):
+			for cursor in ('', '&cursor='):
+				request = HttpRequest()
+				request.GET = QueryDict('sort=price&order=%s%s' % (order, cursor))
+				context = self.views.context_sortable(request, Ad.objects.all())
+				ads = list(context['page'].object_list)
+				self.assertEqual(len(ads), 3)
+				self.assertEqual(ads[-1], missing)
+
+	def test_keyset_pages(self):
+		self.add_ads(3)
+		FieldValue.objects.filter(ad=Ad.objects.order_by('pk')[0], field__name='price').delete()
+		for order in ('asc', 'desc'):
+			seen = []
+			cursor = ''
+			while cursor is not None:
+				request = HttpRequest()
+				request.GET = QueryDict('sort=price&order=%s&perpage=1&cursor=%s' % (order, cursor))
+				page = self.views.context_sortable(request, Ad.objects.all())['page']
+				seen += page.object_list
+				cursor = page.next_cursor
+			self.assertEqual(sorted([ad.pk for ad in seen]), sorted(Ad.objects.values_list('pk', flat=True)))
+
+class CursorTest(TestCase):
+	def test_tampered(self):
+		from classifieds.adposting.keyset import decode_cursor, encode_cursor
+		import base64
+		self.assertEqual(decode_cursor(encode_cursor(1, 'abc', 5)), (1, 'abc', 5))
+		for value in ('[1,"d",5,3]', '[1,"d","x",3]', '[1,"v"]', '{}', 'null', '[[],"v",1,2]'):
+			self.assertEqual(decode_cursor(base64.urlsafe_b64encode(value)), None, value)
+		self.assertEqual(decode_cursor('not base64!'), None)
+
+class LocateTest(AdTestCase):
+	def test_locate_ads(self):
+		from classifieds.adposting.geo import locate_ads
+		self.add_ads(3)
+		Ad.objects.all().update(latitude=None, longitude=None)
+		FieldValue.objects.filter(ad=Ad.objects.order_by('pk')[0], field__name='zip_code').update(value='99999')
+
+		self.assertEqual(locate_ads(batch_size=2), 2)
+		self.assertEqual(Ad.objects.filter(latitude=40.75, longitude=-73.99).count(), 2)
+
+class Clock(object):
+	"""
+	Stands in for the time module in pagecache.
+	"""
+	def __init__(self, now):
+		self.now = now
+
+	def time(self):
+		return self.now
+
+	def mktime(self, t):
+		return time.mktime(t)
+
+class PageCacheTest(AdTestCase):
+	def setUp(self):
+		super(PageCacheTest, self).setUp()
+		self.time = pagecache.time
+		pagecache.time = Clock(1000000.0)
+
+	def tearDown(self):
+		pagecache.time = self.time
+		super(PageCacheTest, self).tearDown()
+
+	def request(self, etag=None):
+		request = HttpRequest()
+		request.method = 'GET'
+		request.path = '/ads/'
+		request.user = AnonymousUser()
+		if etag:
+			request.META['HTTP_IF_NONE_MATCH'] = etag
+		return request
+
+	def test_validators_change_when_rendered_again(self):
+		view = pagecache.cache_anonymous(lambda request: (['schema'], None))(lambda request: HttpResponse('page'))
+		etag = view(self.request())['ETag']
+		self.assertEqual(view(self.request(etag)).status_code, 304)
+
+		# the cached page is gone after PAGE_CACHE_TIMEOUT
+		pagecache.cache.delete('page:' + etag.strip('"').split('-')[0])
+		pagecache.time.now += pagecache.PAGE_CACHE_TIMEOUT
+		response = view(self.request(etag))
+		self.assertEqual(response.status_code, 200)
+		self.assertNotEqual(response['ETag'], etag)
+
+	def test_drafts_keep_versions(self):
+		version = get_version('category:%d' % self.category.pk)
+		Ad.objects.create(category=self.category, user=self.user, expires_on=datetime.datetime.now(), active=False)
+		self.assertEqual(get_version('category:%d' % self.category.pk), version)
+		self.add_ads(1)
+		self.assertNotEqual(get_version('category:%d' % self.category.pk), version)
+
+class ReindexTest(AdTestCase):
+	def test_reindex_field_values(self):
+		from classifieds.adposting.models import reindex_field_values
+		self.add_ads(3)
+		FieldValue.objects.all().update(number=None, sort_key='')
+
+		self.assertEqual(reindex_field_values(batch_size=2), 9)
+		self.assertEqual(FieldValue.objects.filter(field__name='price', number__range=(101, 103)).count(), 3)
+		self.assertEqual(FieldValue.objects.filter(field__name='type', sort_key='full time').count(), 3)
+
+	def test_rebuild_search_index(self):
+		from classifieds.adposting.fulltext import rebuild
+		from classifieds.adposting.models import SearchTerm
+		self.add_ads(3)
+		SearchTerm.objects.all().delete()
+		backend = get_backend()
+		self.assertEqual(backend.filter(Ad.objects.all(), 'guitar').count(), 0)
+
+		self.assertEqual(rebuild(batch_size=2), 3)
+		self.assertEqual(backend.filter(Ad.objects.all(), 'guitar').count(), 3)
+
+class BackfillFeaturedTest(AdTestCase):
+	def test_backfill_featured(self):
+		from classifieds.adposting.cron import backfill_featured
+		from classifieds.adposting.models import Payment, Pricing, PricingOptions
+		from paypal.standard.ipn.models import PayPalIPN
+		self.add_ads(2)
+		running, ended = Ad.objects.order_by('pk')
+		pricing = Pricing.objects.create(length=10, price='10.00')
+		option = PricingOptions.objects.create(name=PricingOptions.FEATURED_LISTING, price='5.00')
+		now = datetime.datetime.now()
+		for ad, days_ago in ((running, 15), (running, 8), (ended, 20)):
+			ipn = PayPalIPN.objects.create(payment_status='Completed', payment_date=now - datetime.timedelta(days=days_ago), txn_id='txn%d%d' % (ad.pk, days_ago), ipaddress='127.0.0.1')
+			payment = Payment.objects.create(ad=ad, pricing=pricing, paypal=ipn)
+			payment.options.add(option)
+
+		self.assertEqual(backfill_featured(), 2)
+		running = Ad.objects.get(pk=running.pk)
+		# the second payment extends the first one's period
+		self.assertEqual(running.featured_until.date(), (now + datetime.timedelta(days=5)).date())
+		self.assertTrue(running.featured)
+		self.assertFalse(Ad.objects.get(pk=ended.pk).featured)
+
+class ImageTest(AdTestCase):
+	def setUp(self):
+		super(ImageTest, self).setUp()
+		from classifieds.adposting.models import AdImage
+		from classifieds.adposting import images
+		import tempfile
+		self.images = images
+		self.storage = AdImage._meta.get_field('full_photo').storage
+		self.location = self.storage.location
+		self.storage.location = tempfile.mkdtemp()
+		self.add_ads(1)
+		self.ad = Ad.objects.get()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.storage.location)
+		self.storage.location = self.location
+		super(ImageTest, self).tearDown()
+
+	def test_errors_dont_stall_the_queue(self):
+		from classifieds.adposting.models import AdImage
+		for i in range(2):
+			AdImage.objects.create(ad=self.ad, full_photo='uploads/%d.jpg' % i)
+		def process(image):
+			# e.g. what a truncated file raises
+			raise ValueError('broken image')
+		AdImage.process, original = process, AdImage.process
+		self.images.logger.disabled = True
+		try:
+			self.assertEqual(self.images.process_pending(), 2)
+		finally:
+			AdImage.process = original
+			self.images.logger.disabled = False
+		self.assertEqual(AdImage.objects.filter(processed=False).count(), 0)
+
+	def test_shrinks_drafted_uploads(self):
+		from classifieds.adposting.models import AdImage
+		from PIL import Image
+		import os
+		os.mkdir(self.storage.path('uploads'))
+		Image.new('RGB', (2560, 1920)).save(self.storage.path('uploads/large.jpg'), 'JPEG')
+		image = AdImage.objects.create(ad=self.ad, full_photo='uploads/large.jpg')
+
+		# the JPEG decoder drafts this at exactly the maximum size
+		image.process()
+		self.assertEqual(Image.open(self.storage.path('uploads/large.jpg')).size, (640, 480))
+		self.assertTrue(AdImage.objects.get(pk=image.pk).processed)
+
+class SitemapTest(AdTestCase):
+	def test_expiry_changes_sections(self):
+		from classifieds.adposting import sitemaps
+		self.add_ads(1)
+		modified = sitemaps.section_modified(None, '0')
+
+		# the ad expires, without being saved
+		time.sleep(0.01)
+		Ad.objects.update(expires_on=datetime.datetime.now())
+		self.assertTrue(sitemaps.section_modified(None, '0') > modified)
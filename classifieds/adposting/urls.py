@@ -23,10 +23,10 @@ urlpatterns = patterns('classifieds.adposting.views',
   (r'^notify_complete$', 'notify_complete'),
 )
 
-from sitemaps import sitemaps
 
 urlpatterns += patterns('',
   (r'^ipn/$', 'paypal.standard.ipn.views.ipn'),
-	(r'^sitemap.xml$', 'django.contrib.sitemaps.views.sitemap', {'sitemaps': sitemaps}),
+	(r'^sitemap.xml$', 'classifieds.adposting.sitemaps.index'),
+	(r'^sitemap-([0-9]+).xml$', 'classifieds.adposting.sitemaps.section'),
 )
 
@@ -0,0 +1,49 @@
+"""
+  $Id$
+
+Version stamps for cached data.
+
+A version is the time (in microseconds) of the last change to whatever the
+key stands for, e.g. 'schema' for the categories and their fields.  Cached
+data is stored under keys that include the version, so bumping the version
+invalidates it everywhere at once.  The stamps live in the Django cache;
+if a stamp gets evicted a new one is made, which only costs a refresh.
+
+"Everywhere" needs a CACHE_BACKEND that all processes share (memcached, the
+database, files).  With the local memory cache, Django's default, each
+process has stamps of its own and doesn't see what the others bump, so
+there the stamps only live for a few minutes (VERSION_LOCAL_TIMEOUT): the
+other processes then make new ones and refresh what they cached.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+import time
+
+# versions are kept for a month with a shared cache, see the note above
+# about evictions, and for a few minutes with a process local one
+if getattr(settings, 'CACHE_BACKEND', 'locmem://').startswith('locmem:'):
+	VERSION_TIMEOUT = getattr(settings, 'VERSION_LOCAL_TIMEOUT', 60 * 5)
+else:
+	VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+def get_version(key):
+	version = cache.get('version:' + key)
+	if version is None:
+		version = bump_version(key)
+	return version
+
+def bump_version(key):
+	version = int(time.time() * 1000000)
+	cache.set('version:' + key, version, VERSION_TIMEOUT)
+	return version
+
+def prune(local_cache, version):
+	"""
+	Drops the entries of a process local cache dict, keyed by tuples that
+	end with a version, that belong to any other version.
+	"""
+	for key in local_cache.keys():
+		if key[-1] != version:
+			del local_cache[key]
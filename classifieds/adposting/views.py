@@ -6,7 +6,6 @@ from django.shortcuts import render_to_response, get_object_or_404
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.utils.translation import ugettext as _
-from django.utils.datastructures import SortedDict
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import REDIRECT_FIELD_NAME
@@ -14,13 +13,21 @@ from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.template import Context, loader, RequestContext
 
 from django.core.paginator import Paginator, InvalidPage
+from django.utils.datastructures import SortedDict
 
-import datetime
+import copy, datetime
 
 from django.conf import settings
 
-from models import Ad, Field, Category, FieldValue, AdImage, Pricing, PricingOptions
+from models import Ad, Field, Category, FieldValue, AdImage, Pricing, PricingOptions, field_schema, load_fields
 from adform import AdForm
+from keyset import keyset_page
+from outerjoin import outer_join
+from images import queue_images
+from versions import get_version, prune
+from pagecache import cache_anonymous
+from options import current_site
+from searchcache import search_cache, normalize_search, facet_counts, SEARCH_CACHE_MAX_RESULTS
 
 from django import forms
 
@@ -29,6 +36,9 @@ from django.forms.models import inlineformset_factory
 from search import *
 
 ADS_PER_PAGE = getattr(settings, 'ADS_PER_PAGE', 5)
+# use cursor based paging for listings, see keyset.py
+# (it is also used whenever the url has a cursor parameter)
+ADS_KEYSET_PAGINATION = getattr(settings, 'ADS_KEYSET_PAGINATION', False)
 
 from PIL import Image
 import string
@@ -50,7 +60,83 @@ def clean_adimageformset(self):
         raise forms.ValidationError(_('Your image must be in one of the following formats: ') + string.join(self.instance.category.images_allowed_formats.values_list('format', flat=True), ','))
     
 
-def context_sortable(request, ads, perpage=ADS_PER_PAGE):
+# featured ads are listed first, see Ad.make_payment and cron.update_featured
+FEATURED_SQL = 'adposting_ad.featured'
+
+# sort parameter => Ad attribute for the sorts on the ad table itself
+SORT_COLUMNS = {
+  'id': 'id',
+  'created_on': 'created_on',
+  'expires_on': 'expires_on',
+  'category': 'category_id',
+  'title': 'title',
+}
+
+# what ads without a value for the custom field sorted on count as, so that
+# they are listed last: column => {order: value}
+SORT_MISSING = {
+  'number': {'': 1e308, '-': -1e308},
+  'sort_key': {'': u'\uffff', '-': u''},
+}
+
+def ads_in_order(ids):
+  ads = Ad.objects.in_bulk(ids)
+  return [ads[pk] for pk in ids if pk in ads]
+
+def sort_spec(ads, sort, order, extra_sorts):
+  """
+  Returns the sorts the listing of ads offers, the sql, params and Ad
+  attribute of the sort key for the given sort, and the (sql, params) of
+  the outer join it needs, if any.
+  """
+  categories = list(Category.objects.filter(ad__in=ads.values('pk').query).distinct())
+  schema = field_schema([category.pk for category in categories])
+  
+  can_sortby_list = []
+  for category in categories:
+    can_sortby_list += category.sortby_fields.split(',')
+
+  sortby_list = ['created_on']
+  sort_fields = {}
+  for category in categories:
+    for field in schema[category.pk]:
+      if field.name in can_sortby_list:
+        if field.name not in sortby_list:
+          sortby_list.append(field.name)
+        sort_fields.setdefault(field.name, []).append(field)
+
+  # sorts that come with the search, like the distance from the searched
+  # zip code; name => (sql, params)
+  sortby_list += extra_sorts.keys()
+
+  sort_params = []
+  join = None
+  if sort in extra_sorts:
+    sort_sql, sort_params = extra_sorts[sort]
+    key_attr = 'sortkey'
+  elif sort in sort_fields:
+    # custom fields are sorted on the typed copy of their value: numbers
+    # for numeric fields, the sort_key otherwise.  The value is outer
+    # joined (on the ad_id, field_id index), so that ads without one stay
+    # in the results; they go last either way.
+    if sort_fields[sort][0].is_numeric():
+      column = 'number'
+    else:
+      column = 'sort_key'
+    field_ids = [field.pk for field in sort_fields[sort]]
+    join = ('adposting_fieldvalue sortvalue ON (sortvalue.ad_id = adposting_ad.id AND sortvalue.field_id IN (' + ','.join(['%s'] * len(field_ids)) + '))', field_ids)
+    sort_sql = 'COALESCE(sortvalue.%s, %%s)' % column
+    sort_params = [SORT_MISSING[column][order]]
+    key_attr = 'sortkey'
+  else:
+    if sort not in SORT_COLUMNS:
+      sort = 'expires_on'
+    sort_sql = 'adposting_ad.' + SORT_COLUMNS[sort]
+    key_attr = SORT_COLUMNS[sort]
+  
+  return sortby_list, sort_sql, sort_params, key_attr, join
+
+def context_sortable(request, ads, perpage=ADS_PER_PAGE, extra_sorts={}, cache_key=None):
   order = '-'
   sort = 'expires_on'
   page = 1
@@ -70,55 +156,83 @@ def context_sortable(request, ads, perpage=ADS_PER_PAGE):
   if request.GET.has_key('sort') and request.GET['sort'] != '':
     sort = request.GET['sort']
 
-  if sort in ['created_on', 'expires_on', 'category', 'title']:
-    ads_sorted = ads.extra(select={'featured': """SELECT 1
-FROM `payment_payment_options`
-LEFT JOIN `payment_payment` ON `payment_payment_options`.`payment_id` = `payment_payment`.`id`
-LEFT JOIN `adposting_pricing` ON `adposting_pricing`.`id` = `payment_payment`.`pricing_id`
-LEFT JOIN `adposting_pricingoptions` ON `payment_payment_options`.`pricingoptions_id` = `adposting_pricingoptions`.`id`
-WHERE `adposting_pricingoptions`.`name` = %s
-AND `payment_payment`.`ad_id` = `adposting_ad`.`id`
-AND `payment_payment`.`paid` =1
-AND `payment_payment`.`paid_on` < NOW()
-AND DATE_ADD( `payment_payment`.`paid_on` , INTERVAL `adposting_pricing`.`length`
-DAY ) > NOW()"""}, select_params=[PricingOptions.FEATURED_LISTING]).extra(order_by=['-featured', order + sort])
+  keyset = ADS_KEYSET_PAGINATION or request.GET.has_key('cursor')
+  
+  # searches cache the ordered ids of their results with what they were
+  # sorted on (see searchcache.py), so that paging and coming back to them
+  # only fetches the ads shown
+  cached = None
+  if cache_key is not None and not keyset:
+    cache_key = cache_key + (sort, order)
+    cached = search_cache.get(cache_key)
+  
+  if cached is None:
+    sortby_list, sort_sql, sort_params, key_attr, join = sort_spec(ads, sort, order, extra_sorts)
   else:
-    # sometimes I surprise myself
-    ads_sorted = ads.extra(select=SortedDict( [('fvorder', 'select value from adposting_fieldvalue LEFT JOIN adposting_field on adposting_fieldvalue.field_id = adposting_field.id where adposting_field.name = %s and adposting_fieldvalue.ad_id = adposting_ad.id'), ('featured', """SELECT 1
-FROM `payment_payment_options`
-LEFT JOIN `payment_payment` ON `payment_payment_options`.`payment_id` = `payment_payment`.`id`
-LEFT JOIN `adposting_pricing` ON `adposting_pricing`.`id` = `payment_payment`.`pricing_id`
-LEFT JOIN `adposting_pricingoptions` ON `payment_payment_options`.`pricingoptions_id` = `adposting_pricingoptions`.`id`
-WHERE `adposting_pricingoptions`.`name` = %s
-AND `payment_payment`.`ad_id` = `adposting_ad`.`id`
-AND `payment_payment`.`paid` =1
-AND `payment_payment`.`paid_on` < NOW()
-AND DATE_ADD( `payment_payment`.`paid_on` , INTERVAL `adposting_pricing`.`length`
-DAY ) > NOW()""")] ), select_params=[sort, PricingOptions.FEATURED_LISTING]).extra(order_by = ['-featured', order + 'fvorder'])
-  
-  pager = Paginator(ads_sorted, perpage)
+    sortby_list, sort_sql, sort_params, join = cached['sortfields'], cached['sort_sql'], cached['sort_params'], cached.get('join')
+  if join is not None:
+    ads = outer_join(ads, *join)
+  
+  # the id breaks ties so that the order is stable from page to page; with
+  # the default sort this is the order of the adposting_ad_listing index
+  ads_sorted = ads.extra(select={'sortkey': sort_sql}, select_params=sort_params).extra(order_by=['-featured', order + 'sortkey', order + 'id'])
+  
+  if keyset:
+    page = keyset_page(ads_sorted, perpage, request.GET.get('cursor', ''), FEATURED_SQL, [], sort_sql, sort_params, key_attr, order == '-')
+    page.object_list = load_fields(page.object_list)
+    no_results = not page.object_list and not page.has_previous()
+    return {'page': page, 'sortfields': sortby_list, 'no_results': no_results, 'perpage': perpage, 'keyset': True}
+  
+  if cache_key is not None and cached is None:
+    cached = {'sortfields': sortby_list, 'sort_sql': sort_sql, 'sort_params': sort_params, 'join': join}
+    # (the sort key has to be selected to be ordered on)
+    ids = [row[0] for row in ads_sorted.values_list('id', 'sortkey')[:SEARCH_CACHE_MAX_RESULTS + 1]]
+    if len(ids) <= SEARCH_CACHE_MAX_RESULTS:
+      cached['ids'] = ids
+      cached['count'] = len(ids)
+    else:
+      # too many to keep; the count is, so that later pages only query
+      # the ads they show
+      cached['ids'] = None
+      cached['count'] = ads_sorted.count()
+    search_cache.set(cache_key, cached)
+  
+  if cached is not None and cached['ids'] is not None:
+    pager = Paginator(cached['ids'], perpage)
+  else:
+    pager = Paginator(ads_sorted, perpage)
+    if cached is not None:
+      pager._count = cached['count']
+  no_results = False
   
   try:
     page = pager.page(page)
+    if cached is not None and cached['ids'] is not None:
+      page.object_list = ads_in_order(page.object_list)
+    # fetch the field values for the whole page at once
+    page.object_list = load_fields(page.object_list)
+    no_results = pager.count == 0
   except InvalidPage:
     page = {'object_list': False}
+  
+  return {'page': page, 'sortfields': sortby_list, 'no_results': no_results, 'perpage': perpage}
 
-  can_sortby_list = []
-  sortby_list = ['created_on']
-  for category in Category.objects.filter(ad__in=ads.values('pk').query).distinct():
-    can_sortby_list += category.sortby_fields.split(',')
+# the version keys and variants of the pages cached for anonymous visitors,
+# see pagecache.py; every page shows the categories in the sidebar
 
-  for category in Category.objects.filter(ad__in=ads.values('pk').query).distinct():
-    for fieldname, in category.field_set.values_list('name'):
-      if fieldname not in sortby_list and fieldname in can_sortby_list:
-        sortby_list.append(fieldname)
+def site_page_key(request, *args):
+  return (['schema'], None)
 
-  for fieldname, in Field.objects.filter(category=None).values_list('name'):
-    if fieldname not in sortby_list and fieldname in can_sortby_list:
-      sortby_list.append(fieldname)
-  
-  return {'page': page, 'sortfields': sortby_list, 'no_results': False, 'perpage': perpage}
+def pricing_page_key(request):
+  return (['schema', 'pricing'], None)
+
+def ad_page_key(request, adId):
+  return (['schema', 'ad:%s' % adId], None)
+
+def search_page_key(request, categoryId):
+  return (['schema', 'category:%s' % categoryId], normalize_search(request.session.get('search', {})))
 
+@cache_anonymous(pricing_page_key)
 def index(request):
   if request.user.is_authenticated() and request.user.is_active:
     return HttpResponseRedirect(reverse('adposting.views.create'))
@@ -168,10 +282,8 @@ def edit(request, adId):
     form = AdForm(ad, request.POST)
     if form.is_valid() and imagesformset.is_valid():
       form.save()
-      imagesformset.save()
-      for image in ad.adimage_set.all():
-        image.resize()
-        image.generate_thumbnail()
+      # only new and replaced images need processing
+      queue_images(imagesformset.save())
       return HttpResponseRedirect(reverse('adposting.views.mine'))
   else:
     imagesformset = ImageUploadFormSet(request.POST, request.FILES, instance=ad)
@@ -179,6 +291,7 @@ def edit(request, adId):
   
   return render_to_response('adposting/category/' + ad.category.template_prefix + '/edit.html', {'form': form, 'imagesformset': imagesformset, 'ad': ad}, context_instance=RequestContext(request))
 
+@cache_anonymous(ad_page_key)
 def view(request, adId):
   # find the ad, if available
   ad = get_object_or_404(Ad, pk=adId, active=True)
@@ -186,7 +299,9 @@ def view(request, adId):
   if ad.expires_on < datetime.datetime.now() and ad.user != request.user:
     raise Http404
   
-  return render_to_response('adposting/category/' + ad.category.template_prefix + '/view.html', {'ad': ad}, context_instance=RequestContext(request))
+  response = render_to_response('adposting/category/' + ad.category.template_prefix + '/view.html', {'ad': ad}, context_instance=RequestContext(request))
+  response.cache_until = ad.expires_on
+  return response
 
 @login_required
 def view_bought(request, adId):
@@ -223,10 +338,8 @@ def create_edit(request, adId):
     if form.is_valid():# and imagesformset.is_valid():
       ad = form.save()
       if imagesformset.is_valid():
-        imagesformset.save()
-        for image in ad.adimage_set.all():
-          image.resize()
-          image.generate_thumbnail()
+        # only new and replaced images need processing
+        queue_images(imagesformset.save())
         
         return HttpResponseRedirect(reverse('adposting.views.create_preview', args=[ad.pk]))
   else:
@@ -242,6 +355,7 @@ def create_preview(request, adId):
   
   return render_to_response('adposting/category/' + ad.category.template_prefix + '/preview.html', {'ad': ad, 'create': True}, context_instance=RequestContext(request))
 
+@cache_anonymous(site_page_key)
 def search(request):
   # list categories available and send the user to the search_in_category view
   return render_to_response('adposting/category_choice.html', {'categories': Category.objects.all(), 'type': 'search'}, context_instance=RequestContext(request))
@@ -254,19 +368,41 @@ def search_in_category(request, categoryId):
   
   return search_results(request, categoryId)
 
-def prepare_sforms(fields, fields_left, post=None):
+# (category id, schema version) => select fields of the search form
+_search_fields = {}
+
+def search_select_fields(category_id):
+  # the dropdown list fields are searched with multiple selects, built
+  # once per category and schema version like the AdForm fields
+  key = (category_id, get_version('schema'))
+  if key not in _search_fields:
+    prune(_search_fields, key[1])
+    select_fields = SortedDict()
+    for field in field_schema([category_id])[category_id]:
+      if field.field_type == Field.SELECT_FIELD:  # is select field
+        # add select field
+        options = field.options.split(',')
+        choices = zip(options, options)
+        choices.insert(0, ('', 'Any',))
+        select_fields[field.name] = forms.ChoiceField(label=field.label, required=False, help_text=field.help_text + u'\nHold ctrl or command on Mac for multiple selections.', choices=choices, widget=forms.SelectMultiple)
+    _search_fields[key] = select_fields
+  
+  return _search_fields[key]
+
+def prepare_sforms(category_id, fields_left, post=None):
   sforms = []
-  select_fields = {}
-  for field in fields:
-    if field.field_type == Field.SELECT_FIELD:  # is select field
-      # add select field
-      options = field.options.split(',')
-      choices = zip(options, options)
-      choices.insert(0, ('', 'Any',))
-      form_field = forms.ChoiceField(label=field.label, required=False, help_text=field.help_text + u'\nHold ctrl or command on Mac for multiple selections.', choices=choices, widget=forms.SelectMultiple)
-      # remove this field from fields_list
-      fields_left.remove( field.name )
-      select_fields[field.name] = form_field
+  fields = field_schema([category_id])[category_id]
+  select_fields = copy.deepcopy(search_select_fields(category_id))
+  field_ids = dict([(field.name, field.pk) for field in fields])
+  counts = facet_counts(category_id, [field_ids[name] for name in select_fields.keys()])
+  for name, select_field in select_fields.items():
+    # remove this field from fields_list
+    fields_left.remove( name )
+    # show the number of ads next to each option
+    choices = select_field.choices[:1]
+    for value, label in select_field.choices[1:]:
+      choices.append((value, u'%s (%d)' % (label, counts.get((field_ids[name], value), 0))))
+    select_field.choices = choices
       
   sforms.append(SelectForm.create(select_fields, post))
   
@@ -277,11 +413,10 @@ def prepare_sforms(fields, fields_left, post=None):
   
   return sforms
 
+@cache_anonymous(search_page_key)
 def search_results(request, categoryId):
   cat = get_object_or_404(Category, pk=categoryId)
-  fields = list(cat.field_set.all())
-  fields += list(Field.objects.filter(category=None))
-  fieldsLeft = [field.name for field in fields]
+  fieldsLeft = [field.name for field in field_schema([cat.pk])[cat.pk]]
   
   if request.method == "POST" or request.session.has_key('search'):
     ads = cat.ad_set.filter(active=True,expires_on__gt=datetime.datetime.now())
@@ -293,7 +428,7 @@ def search_results(request, categoryId):
     else:
       post.update(request.POST)
     
-    sforms = prepare_sforms(fields, fieldsLeft, post)
+    sforms = prepare_sforms(cat.pk, fieldsLeft, post)
 
     isValid = True
     #validErrors = {}
@@ -309,17 +444,17 @@ def search_results(request, categoryId):
         request.session['search'].update(request.POST)
         return HttpResponseRedirect(reverse('adposting.views.search_results', args=[categoryId]))
       
+      extra_sorts = SortedDict()
       for f in sforms:
         ads = f.filter(ads)
+        extra_sorts.update(getattr(f, 'extra_sorts', {}))
     
-      if ads.count() == 0:
-        return render_to_response('adposting/list.html', {'no_results':True, 'category':cat}, context_instance=RequestContext(request))
-      else:
-        context = context_sortable(request, ads)
-        context['category'] = cat
-        return render_to_response('adposting/list.html', context, context_instance=RequestContext(request))
+      cache_key = ('search', cat.pk, normalize_search(post), get_version('category:%d' % cat.pk))
+      context = context_sortable(request, ads, extra_sorts=extra_sorts, cache_key=cache_key)
+      context['category'] = cat
+      return render_to_response('adposting/list.html', context, context_instance=RequestContext(request))
   else:
-    sforms = prepare_sforms(fields, fieldsLeft)
+    sforms = prepare_sforms(cat.pk, fieldsLeft)
     
   return render_to_response('adposting/search.html', {'forms':sforms, 'category':cat}, context_instance=RequestContext(request))
   
@@ -355,7 +490,7 @@ def checkout(request, adId):
       # 2. send email
       send_mail(_('Your ad will be posted shortly.'), email_contents, settings.FROM_EMAIL, [ad.user.email], fail_silently=False)
       
-      item_name = _('Your ad on ') + Site.objects.get_current().name 
+      item_name = _('Your ad on ') + current_site().name 
       paypal_values = {'amount': total, 'item_name': item_name, 'item_number': payment.pk, 'quantity': 1}
       if settings.DEBUG:
         paypal_form = PayPalPaymentsForm(initial=paypal_values).sandbox()
@@ -1,7 +1,7 @@
 """
   $Id$
 """
-from django.contrib.sites.models import Site
+from classifieds.adposting.options import current_site
 
 def sites(request):
-	return {'site': Site.objects.get_current()}
+	return {'site': current_site()}
@@ -1,25 +1,160 @@
 #!/usr/bin/env python
 """
   $Id$
+
+Runs the periodic jobs of the applications.
+
+Every module listed below may define jobs, a sequence of (name, function)
+pairs; the functions return the number of rows (emails, ads, images) they
+handled.  Modules with only a run() function are run as a single job.
+
+Each job runs in its own worker process, all of them at the same time, and
+holds a file lock while it runs, so a job that is still busy from the
+previous invocation is skipped instead of run twice.  A failing job doesn't
+affect the others.
+
+  python cron.py [--dry-run] [--only NAME[,NAME...]]
 """
-modules = ('adposting', 'payment', 'accounts',)
 
-cronjobs = []
-for module in modules:
-	module = module+'.cron'
+from optparse import OptionParser
+
+import fcntl, os, sys, tempfile, time, traceback
+
+modules = ('adposting.cron', 'adposting.images', 'payment.cron', 'accounts.cron',)
+
+# directory of the lock files
+LOCK_DIR = tempfile.gettempdir()
+
+def load_jobs():
+	"""
+	Returns a list of (name, function) for the jobs of all modules; the
+	names are prefixed with the application, e.g. 'adposting.purge'.
+	"""
+	cronjobs = []
+	for module in modules:
+		try:
+			mod = __import__(module)
+			components = module.split('.')
+			for comp in components[1:]:
+				mod = getattr(mod, comp)
+		except (AttributeError, ImportError):
+			continue
+
+		app = module.split('.')[0]
+		if hasattr(mod, 'jobs'):
+			for name, job in mod.jobs:
+				cronjobs.append((app + '.' + name, job))
+		elif hasattr(mod, 'run'):
+			cronjobs.append((module, mod.run))
+	return cronjobs
+
+def lock(name):
+	"""
+	Returns the open lock file of the job, or None if another process
+	holds the lock.  The lock goes away with the process.
+	"""
+	f = open(os.path.join(LOCK_DIR, 'classifieds-cron-%s.lock' % name), 'w')
 	try:
-		mod = __import__(module)
-		components = module.split('.')
-		for comp in components[1:]:
-			mod = getattr(mod, comp)
+		fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except IOError:
+		f.close()
+		return None
+	return f
+
+def start(name, job):
+	"""
+	Forks a worker for the job.  Returns (pid, file to read its result from):
+	'locked', or the number of rows and the seconds the job took.
+	"""
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid:
+		os.close(w)
+		return pid, os.fdopen(r)
+
+	# the worker
+	os.close(r)
+	out = os.fdopen(w, 'w')
+	status = 1
+	started = None
+	try:
+		try:
+			# don't share the parent's database connection
+			from django.db import connection
+			connection.close()
+
+			lock_file = lock(name)
+			if lock_file is None:
+				out.write('locked')
+				status = 0
+			else:
+				# timed here, the parent only learns about it when it gets
+				# to this worker's pipe
+				started = time.time()
+				rows = job()
+				out.write('%s %f' % (rows or 0, time.time() - started))
+				status = 0
+		except:
+			traceback.print_exc()
+			if started is not None:
+				out.write('- %f' % (time.time() - started))
+	finally:
+		out.close()
+		os._exit(status)
+
+def run_jobs(cronjobs):
+	"""
+	Runs the jobs in parallel and prints their results.  Returns the number
+	of jobs that failed.
+	"""
+	workers = []
+	for name, job in cronjobs:
+		pid, result = start(name, job)
+		workers.append((name, pid, result))
+
+	failed = 0
+	for name, pid, result in workers:
+		output = result.read().split()
+		result.close()
+		pid, status = os.waitpid(pid, 0)
+		if status != 0:
+			failed += 1
+			if len(output) == 2:
+				print '%-30s failed     %8.2fs' % (name, float(output[1]))
+			else:
+				print '%-30s failed' % name
+		elif output == ['locked']:
+			print '%-30s skipped (still running elsewhere)' % name
+		else:
+			rows, seconds = output
+			print '%-30s ok         %8.2fs %8s rows' % (name, float(seconds), rows)
+	return failed
+
+def main(argv):
+	parser = OptionParser(usage='%prog [--dry-run] [--only NAME[,NAME...]]')
+	parser.add_option('-n', '--dry-run', action='store_true', default=False, help='list the jobs that would run, without running them')
+	parser.add_option('-o', '--only', action='append', default=[], help='only run the named jobs (e.g. adposting.purge)')
+	options, args = parser.parse_args(argv)
+
+	cronjobs = load_jobs()
+	if options.only:
+		names = []
+		for only in options.only:
+			names += only.split(',')
+		unknown = [name for name in names if name not in [job[0] for job in cronjobs]]
+		if unknown:
+			parser.error('unknown job(s): ' + ', '.join(unknown))
+		cronjobs = [job for job in cronjobs if job[0] in names]
 
-		cronjobs.append(mod.run)
-	except AttributeError:
-		pass
-	except ImportError:
-		pass
+	if options.dry_run:
+		for name, job in cronjobs:
+			print name
+		return 0
 
-for cronjob in cronjobs:
-	cronjob()
-	
+	sys.stdout.flush()
+	if run_jobs(cronjobs):
+		return 1
+	return 0
 
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
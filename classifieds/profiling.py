@@ -0,0 +1,139 @@
+"""
+  $Id$
+
+SQL query profiling.
+
+QueryProfile records the queries run while it is active, also without
+DEBUG, and summarizes them: how many there were, the time they took, the
+statements that ran more than once and the N+1 patterns, i.e. the same
+statement run many times with different parameters, like a query per ad
+on a list page.
+
+	profile = QueryProfile('digest')
+	profile.start()
+	...
+	profile.stop()
+	print profile.summary()
+
+or, with Python 2.5 and later, "with QueryProfile('digest') as profile:".
+
+QueryProfileMiddleware profiles every request: it adds X-DB-Queries and
+X-DB-Time headers to the response and logs a JSON summary for a sample of
+the requests (PROFILER_SAMPLE_RATE) to PROFILER_LOG_FILE.  The
+profile_report management command summarizes that log by view.
+"""
+
+from django.conf import settings
+from django.db import connection
+from django.db.backends.util import CursorDebugWrapper
+from django.utils import simplejson
+
+import logging, random, re, time
+
+# fraction of the requests that are logged
+PROFILER_SAMPLE_RATE = getattr(settings, 'PROFILER_SAMPLE_RATE', 0.01)
+PROFILER_LOG_FILE = getattr(settings, 'PROFILER_LOG_FILE', None)
+# a statement that runs this often with different parameters is an N+1
+N_PLUS_ONE_THRESHOLD = getattr(settings, 'PROFILER_N_PLUS_ONE_THRESHOLD', 5)
+
+logger = logging.getLogger('classifieds.profiling')
+if PROFILER_LOG_FILE and not logger.handlers:
+	logger.addHandler(logging.FileHandler(PROFILER_LOG_FILE))
+	logger.setLevel(logging.INFO)
+
+def fingerprint(sql):
+	"""
+	The statement with its literals replaced, so that queries that only
+	differ in their parameters have the same fingerprint.
+	"""
+	sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+	sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+	sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(...)', sql)
+	return re.sub(r'\s+', ' ', sql).strip()
+
+def profiled_cursor():
+	"""
+	Stands in for connection.cursor while a profile is active: the cursors
+	are wrapped to record their queries in connection.queries, as they are
+	with DEBUG.
+	"""
+	cursor = connection.__class__.cursor(connection)
+	if not isinstance(cursor, CursorDebugWrapper):
+		cursor = CursorDebugWrapper(cursor, connection)
+	return cursor
+
+class QueryProfile(object):
+	def __init__(self, name=''):
+		self.name = name
+		self.queries = []
+		self.duration = 0.0
+
+	def start(self):
+		# profiles can be nested; the outermost one installs the cursor
+		# (the connection is per thread, so this is too)
+		self.outermost = getattr(connection, 'cursor', None) is not profiled_cursor
+		if self.outermost:
+			connection.cursor = profiled_cursor
+		self.first = len(connection.queries)
+		self.started = time.time()
+		return self
+
+	def stop(self):
+		self.duration = time.time() - self.started
+		self.queries = connection.queries[self.first:]
+		if self.outermost:
+			del connection.cursor
+			if not settings.DEBUG:
+				# don't let a long running process collect every query
+				del connection.queries[self.first:]
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *exc_info):
+		self.stop()
+
+	def summary(self):
+		counts = {}
+		statements = {}
+		db_time = 0.0
+		for query in self.queries:
+			db_time += float(query['time'])
+			counts[query['sql']] = counts.get(query['sql'], 0) + 1
+			statements.setdefault(fingerprint(query['sql']), set()).add(query['sql'])
+
+		duplicates = [(count, sql) for sql, count in counts.items() if count > 1]
+		duplicates.sort(reverse=True)
+		n_plus_one = [(len(sqls), pattern) for pattern, sqls in statements.items() if len(sqls) >= N_PLUS_ONE_THRESHOLD]
+		n_plus_one.sort(reverse=True)
+
+		return {
+			'name': self.name,
+			'queries': len(self.queries),
+			'db_time': round(db_time, 4),
+			'time': round(self.duration, 4),
+			'duplicates': [{'count': count, 'sql': sql} for count, sql in duplicates],
+			'n_plus_one': [{'count': count, 'fingerprint': pattern} for count, pattern in n_plus_one],
+		}
+
+class QueryProfileMiddleware(object):
+	def process_request(self, request):
+		request._query_profile = QueryProfile(request.path).start()
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		if hasattr(request, '_query_profile'):
+			request._query_profile.name = '%s.%s' % (view_func.__module__, view_func.__name__)
+
+	def process_response(self, request, response):
+		profile = getattr(request, '_query_profile', None)
+		if profile is None:
+			return response
+		profile.stop()
+		summary = profile.summary()
+		response['X-DB-Queries'] = str(summary['queries'])
+		response['X-DB-Time'] = '%.4f' % summary['db_time']
+		if random.random() < PROFILER_SAMPLE_RATE:
+			summary['path'] = request.path
+			summary['status'] = response.status_code
+			logger.info(simplejson.dumps(summary))
+		return response
@@ -4,5 +4,9 @@
 from django.contrib import admin
 from models import SiteAd
 
-admin.site.register([SiteAd])
+class SiteAdAdmin(admin.ModelAdmin):
+	list_display = ('title', 'slot', 'enabled', 'weight', 'impressions', 'clicks')
+	list_filter = ('slot', 'enabled')
+
+admin.site.register(SiteAd, SiteAdAdmin)
 
@@ -0,0 +1,62 @@
+"""
+  $Id$
+
+Buffered impression and click counters for the site ads.
+
+Counting every impression with an UPDATE would add a write to every page
+view.  Instead each process adds the counts up in memory and writes them
+out with one UPDATE per ad at most every COUNTER_FLUSH_INTERVAL seconds
+(and when it exits).  A process that gets killed loses its last few
+seconds of counts.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+import atexit, threading, time
+
+COUNTER_FLUSH_INTERVAL = getattr(settings, 'SITEADS_COUNTER_FLUSH_INTERVAL', 30)
+
+# SiteAd pk => [impressions, clicks]
+_counts = {}
+_lock = threading.Lock()
+_last_flush = [time.time()]
+
+def count(impressions=(), clicks=()):
+	"""
+	Counts an impression for every SiteAd pk in impressions and a click for
+	every pk in clicks, flushing the counts if it is time to.
+	"""
+	_lock.acquire()
+	try:
+		for pk in impressions:
+			_counts.setdefault(pk, [0, 0])[0] += 1
+		for pk in clicks:
+			_counts.setdefault(pk, [0, 0])[1] += 1
+		due = time.time() - _last_flush[0] >= COUNTER_FLUSH_INTERVAL
+	finally:
+		_lock.release()
+	
+	if due:
+		flush()
+
+def flush():
+	"""
+	Adds the buffered counts to the database.
+	"""
+	from classifieds.siteads.models import SiteAd
+	_lock.acquire()
+	try:
+		counts = _counts.items()
+		_counts.clear()
+		_last_flush[0] = time.time()
+	finally:
+		_lock.release()
+	
+	for pk, (impressions, clicks) in counts:
+		SiteAd.objects.filter(pk=pk).update(impressions=F('impressions') + impressions, clicks=F('clicks') + clicks)
+	if counts:
+		transaction.commit_unless_managed()
+
+atexit.register(flush)
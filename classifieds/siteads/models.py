@@ -2,7 +2,15 @@
   $Id$
 """
 from django.db import models
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.contrib.sites.models import Site
+from django.conf import settings
+
+import random, time
+
+# seconds the enabled ads are kept in memory; changes made through other
+# processes show up after at most this long
+SITEADS_CACHE_TIMEOUT = getattr(settings, 'SITEADS_CACHE_TIMEOUT', 60)
 
 class SiteAd(models.Model):
 	SLOT_CHOICES = (
@@ -16,8 +24,44 @@ class SiteAd(models.Model):
 	title = models.CharField(max_length=200)
 	html = models.TextField()
 	enabled = models.BooleanField()
+	# how often the ad is shown relative to the other ads in its slot
+	weight = models.PositiveIntegerField(default=1)
+	url = models.URLField(blank=True, verify_exists=False, help_text='Where {{ click_url }} in the html leads to; clicks on it are counted.')
+	# see counters.py
+	impressions = models.PositiveIntegerField(default=0, editable=False)
+	clicks = models.PositiveIntegerField(default=0, editable=False)
 	
 	def __unicode__(self):
 		return self.get_slot_display() + u' ad: "' + self.title + u'"'
-	
 
+# (site id, slot) => (expiry time, list of enabled SiteAds)
+_enabled_ads = {}
+
+def enabled_ads(site_id, slot):
+	"""
+	Returns the enabled ads for the slot on the site, from memory.
+	"""
+	key = (site_id, slot)
+	entry = _enabled_ads.get(key)
+	if entry is None or entry[0] < time.time():
+		ads = list(SiteAd.objects.filter(slot=slot, enabled=True, site__id__exact=site_id))
+		entry = (time.time() + SITEADS_CACHE_TIMEOUT, ads)
+		_enabled_ads[key] = entry
+	return entry[1]
+
+def pick_ads(ads, number):
+	"""
+	Picks up to number different ads, each with a chance proportional to
+	its weight (weighted sampling without replacement, after Efraimidis
+	and Spirakis: the ads with the largest random() ** (1 / weight) win).
+	"""
+	keyed = [(random.random() ** (1.0 / ad.weight), ad) for ad in ads if ad.weight > 0]
+	keyed.sort(key=lambda item: item[0], reverse=True)
+	return [ad for key, ad in keyed[:number]]
+
+def clear_enabled_ads(sender=None, **kwargs):
+	_enabled_ads.clear()
+
+post_save.connect(clear_enabled_ads, sender=SiteAd)
+post_delete.connect(clear_enabled_ads, sender=SiteAd)
+m2m_changed.connect(clear_enabled_ads, sender=SiteAd.site.through)
@@ -3,33 +3,57 @@
 """
 from django import template
 from django.utils.safestring import mark_safe
+from django.core.urlresolvers import reverse
 
-from classifieds.siteads.models import SiteAd
+from classifieds.siteads.models import enabled_ads, pick_ads
+from classifieds.siteads import counters
 
 from django.conf import settings
 
-import random
+import re
 
 register = template.Library()
 
+def render_slot(slot):
+	"""
+	Returns the html of the ads picked for the slot, counting their
+	impressions.
+	"""
+	number = 1
+	if slot == 'sponsored':
+		number = int(settings.SPONSORED_ADS_COUNT)
+	
+	# different ads for each position of the slot
+	ads = pick_ads(enabled_ads(settings.SITE_ID, slot), number)
+	counters.count(impressions=[ad.pk for ad in ads])
+	
+	output = ''
+	for ad in ads:
+		html = ad.html
+		if ad.url:
+			html = html.replace('{{ click_url }}', reverse('sitead_click', args=[ad.pk]))
+		output += html
+	return output
+
+# what the tag leaves in pages that are cached as a whole, so that the ads
+# are picked again each time the page is served (see adposting/pagecache.py)
+SLOT_MARKER = '<!--sitead:%s-->'
+SLOT_MARKER_RE = re.compile(r'<!--sitead:([\w-]+)-->')
+
+def fill_slots(content):
+	"""
+	Replaces the slot markers in content (a utf-8 string) with ads.
+	"""
+	return SLOT_MARKER_RE.sub(lambda m: render_slot(m.group(1)).encode('utf-8'), content)
+
 class SiteAdNode(template.Node):
 	def __init__(self, slot_string):
 		self.slot_string = slot_string
 	
 	def render(self, context):
-		output = ''
-		number = 1
-		if self.slot_string == 'sponsored':
-			number = int(settings.SPONSORED_ADS_COUNT)
-		
-		for x in range(0, number):
-			try:
-				ad = random.choice(SiteAd.objects.filter(slot=self.slot_string,enabled=True,site__id__exact=settings.SITE_ID))
-				output += ad.html
-			except IndexError:
-				pass
-			
-		return mark_safe(output)
+		if getattr(context.get('request'), 'defer_siteads', False):
+			return mark_safe(SLOT_MARKER % self.slot_string)
+		return mark_safe(render_slot(self.slot_string))
 
 def do_sitead(parser, token):
 	# from the django docs...
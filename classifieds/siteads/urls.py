@@ -0,0 +1,8 @@
+"""
+  $Id$
+"""
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('classifieds.siteads.views',
+	url(r'^click/([0-9]+)/$', 'click', name='sitead_click'),
+)
@@ -1,4 +1,15 @@
 """
   $Id$
 """
-# Create your views here.
+from django.shortcuts import get_object_or_404
+from django.http import HttpResponseRedirect, Http404
+
+from models import SiteAd
+import counters
+
+def click(request, adId):
+	ad = get_object_or_404(SiteAd, pk=adId)
+	if not ad.url:
+		raise Http404
+	counters.count(clicks=[ad.pk])
+	return HttpResponseRedirect(ad.url)
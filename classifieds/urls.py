@@ -31,6 +31,7 @@ urlpatterns = patterns('',
 	# our views (included from the apps)
 	(r'^ads/', include('iportal.classifieds.adposting.urls')),
 	(r'^contact/', include('iportal.classifieds.contact.urls')),
+	(r'^siteads/', include('iportal.classifieds.siteads.urls')),
 	
 	# add-on apps.
 	(r'^registration/', include('registration.urls')),